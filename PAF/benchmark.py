@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+PAF - Benchmarks of the recognition building blocks
+Usage: python3 PAF/benchmark.py <test> [options]
+"""
+
+import sys, time
+import argparse
+import numpy as np
+
+import settings # Local settings
+from lib.gallery import FaceGallery
+
+def syntheticGallery(targets, templatesPerTarget, seed=0): # Random descriptors with the same scale of dlib ones
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 0.09, (targets, FaceGallery.DIM)).astype(np.float32)
+    templates = np.repeat(centers, templatesPerTarget, axis=0) + rng.normal(0, 0.03, (targets*templatesPerTarget, FaceGallery.DIM)).astype(np.float32)
+    ids = np.repeat(np.arange(targets), templatesPerTarget)
+    return FaceGallery(templates, ids, {i: 'Target %s' % i for i in range(targets)}), centers
+
+def benchAnn(args):
+    """
+    Recall and latency of the approximate face index compared to exact search
+    """
+    rng = np.random.default_rng(1)
+    exact, centers = syntheticGallery(args.targets, args.templates)
+    queries = centers[rng.integers(0, len(centers), args.queries)] + rng.normal(0, 0.03, (args.queries, FaceGallery.DIM)).astype(np.float32)
+    t = time.perf_counter()
+    truth = [exact.match(q, settings.MAX_DISTANCE) for q in queries]
+    exactTime = (time.perf_counter() - t) / len(queries)
+    print('Templates: %s, queries: %s' % (len(exact), len(queries)))
+    print('%-10s %10s %12s %10s' % ('probes', 'recall', 'ms/query', 'speedup'))
+    print('%-10s %10.4f %12.3f %10.1f' % ('exact', 1, exactTime*1000, 1))
+    approx, _ = syntheticGallery(args.targets, args.templates)
+    t = time.perf_counter()
+    approx.buildIndex(1, 0, args.lists)
+    print('Index built in %.2f s (%s lists)' % (time.perf_counter() - t, len(approx.index.centroids)))
+    for probes in args.probes:
+        approx.probes = probes
+        t = time.perf_counter()
+        res = [approx.match(q, settings.MAX_DISTANCE) for q in queries]
+        annTime = (time.perf_counter() - t) / len(queries)
+        recall = np.mean([ r[0] == e[0] for r, e in zip(res, truth) ])
+        print('%-10s %10.4f %12.3f %10.1f' % (probes, recall, annTime*1000, exactTime/annTime))
+
+def benchDescriptors(args):
+    """
+    Per-face cost of descriptors computed one by one vs a single batched call, on a (crowded) image
+    """
+    import dlib, cv2
+    detector = dlib.get_frontal_face_detector()
+    predictor = dlib.shape_predictor(settings.SHAPE_PREDICTOR)
+    model = dlib.face_recognition_model_v1(settings.FACE_RECOGNITION_MODEL)
+    img = cv2.imread(args.image)
+    if img is None:
+        sys.exit('Cannot read %s' % args.image)
+    rects = detector(img, 1)
+    if not len(rects):
+        sys.exit('No faces found in %s' % args.image)
+    t = time.perf_counter()
+    for _ in range(args.repeat):
+        single = [ model.compute_face_descriptor(img, predictor(img, r)) for r in rects ]
+    singleTime = (time.perf_counter() - t) / args.repeat / len(rects)
+    t = time.perf_counter()
+    for _ in range(args.repeat):
+        shapes = dlib.full_object_detections()
+        for r in rects:
+            shapes.append(predictor(img, r))
+        batch = model.compute_face_descriptor(img, shapes)
+    batchTime = (time.perf_counter() - t) / args.repeat / len(rects)
+    maxDiff = max( np.abs(np.array(a) - np.array(b)).max() for a, b in zip(single, batch) )
+    print('Faces: %s' % len(rects))
+    print('One by one: %.2f ms/face' % (singleTime*1000))
+    print('Batched:    %.2f ms/face (%.1fx, max difference %.1e)' % (batchTime*1000, singleTime/batchTime, maxDiff))
+
+def benchPlates(args):
+    """
+    Frames per second of the plate search: full frame rotations (old) vs rotations on candidate regions in parallel
+    """
+    import cv2, openalpr
+    from lib.plates import AlprPool, PlateReader, rotate_image, bestResult
+    def newAlpr():
+        alpr = openalpr.Alpr(settings.OPENALPR_COUNTRY, settings.OPENALPR_CONF, settings.OPENALPR_RUNTIME_DATA)
+        alpr.set_top_n(1)
+        return alpr
+    def fullFrameSearch(alpr, frame): # Previous implementation
+        candidates = bestResult(alpr.recognize_ndarray(frame), settings.OPENALPR_MIN_CONFIDENCE)
+        for angle in settings.OPENALPR_ROTATIONS:
+            if candidates:
+                break
+            candidates = bestResult(alpr.recognize_ndarray(rotate_image(frame, angle)), settings.OPENALPR_MIN_CONFIDENCE)
+        return candidates
+    cap = cv2.VideoCapture(args.video)
+    frames = []
+    while len(frames) < args.frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        sys.exit('Cannot read %s' % args.video)
+    alpr = newAlpr()
+    reader = PlateReader(AlprPool(newAlpr, args.threads), settings.OPENALPR_ROTATIONS, settings.OPENALPR_MIN_CONFIDENCE, settings.OPENALPR_MAX_REGIONS)
+    print('Frames: %s' % len(frames))
+    for name, search in (('Full frame', lambda f: fullFrameSearch(alpr, f)), ('Regions', reader.read)):
+        t = time.perf_counter()
+        found = sum( 1 for f in frames if search(f) )
+        elapsed = time.perf_counter() - t
+        print('%-12s %8.2f fps, plates in %s frames' % (name, len(frames)/elapsed, found))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PAF benchmarks')
+    sub = parser.add_subparsers(dest='test')
+    p = sub.add_parser('ann', help='approximate face index vs exact search')
+    p.add_argument('--targets', type=int, default=25000)
+    p.add_argument('--templates', type=int, default=4, help='templates per target')
+    p.add_argument('--queries', type=int, default=500)
+    p.add_argument('--lists', type=int, default=settings.FACE_INDEX_LISTS)
+    p.add_argument('--probes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    p.set_defaults(func=benchAnn)
+    p = sub.add_parser('descriptors', help='batched vs single face descriptors')
+    p.add_argument('image', help='image with several faces')
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=benchDescriptors)
+    p = sub.add_parser('plates', help='plate search with rotations, old vs new')
+    p.add_argument('video', help='video file with plates')
+    p.add_argument('--frames', type=int, default=200)
+    p.add_argument('--threads', type=int, default=settings.OPENALPR_THREADS)
+    p.set_defaults(func=benchPlates)
+    args = parser.parse_args()
+    if not args.test:
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
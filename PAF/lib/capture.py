@@ -1,41 +1,363 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import time, subprocess, json
 import cv2
-from threading import Thread
+import numpy as np
+from threading import Thread, Event, Condition
+
+def sharpness(frame, width=320): # Variance of the Laplacian on a small grayscale copy, higher is sharper
+    height = max(int(frame.shape[0] * width / frame.shape[1]), 1)
+    small = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+    return cv2.Laplacian(gray, cv2.CV_32F).var()
 
 # Non blocking video capture!
+# Every frame gets a sequence number and the monotonic time it was grabbed: read() never returns the same frame twice.
+# With buffer > 0 every frame is decoded into a preallocated ring of the last frames, read() returns the sharpest one not yet read.
+# With stallTimeout > 0 a live stream without frames for that time is reopened by the grab thread, with exponential backoff
 class Capture:
-    def __init__(self,source=0): # Source 0 is the default (usually webcam)
+    def __init__(self,source=0,fps=25,buffer=0,stallTimeout=0,maxDelay=60): # Source 0 is the default (usually webcam), fps is used if the source does not report it
         if not isinstance(source, int) and source.isdigit():
             source = int(source)
-        self.video_capture = cv2.VideoCapture(source)
+        self.source = source
+        self.flip = cv2.flip if source == 0 else lambda f, *a, **k: f # Flip around y axis only if is PC webcam
+        self.live = not isinstance(source,str) or '://' in source # Live streams block on their own cadence, files must be paced
+        self.defaultFps = fps
+        self.setup(fps, buffer, stallTimeout, maxDelay)
+        try:
+            self.open()
+            self.state = 'connecting' if stallTimeout and self.live else 'connected' # Self-healing streams are connected at the first frame
+            self.aliveTime = time.monotonic() # Stall timeout from the end of open() (probing may take long)
+        except ValueError:
+            if not (stallTimeout and isinstance(source,str) and self.live): # A stream that is down now is opened later by the grab thread
+                raise
+
+    def open(self):
+        params = []
+        if self.stallTimeout and hasattr(cv2, 'CAP_PROP_READ_TIMEOUT_MSEC'): # A dead stream must not block grab() for long (OpenCV >= 4.5)
+            params = [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(self.stallTimeout*1000), cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(self.stallTimeout*1000)]
+        self.video_capture = cv2.VideoCapture(self.source, cv2.CAP_ANY, params) if params else cv2.VideoCapture(self.source)
         if not self.video_capture.isOpened():
             raise ValueError('Cannot open source!')
-        self.flip = cv2.flip if source == 0 else lambda f, *a, **k: f # Flip around y axis only if is PC webcam
+        self.retrieve = self.video_capture.retrieve if isinstance(self.source,str) else self.video_capture.read
+        self.grab = self.video_capture.grab if isinstance(self.source,str) else None # Grab only if it is not PC webcam (read in read())
+        sourceFps = self.video_capture.get(cv2.CAP_PROP_FPS)
+        self.fps = sourceFps if 0 < sourceFps <= 240 else self.defaultFps # Some streams report 0 or nonsense
+
+    def close(self):
+        self.video_capture.release()
+
+    def interrupt(self): # Unblock a stalled grab (OpenCV relies on its read timeout)
+        pass
+
+    def setup(self, fps, buffer, stallTimeout=0, maxDelay=60): # State shared by every backend
         self.running = False
+        self.stopped = Event() # Interrupts the waits of the grab thread
         self.t=Thread(target=self.loop)
         self.t.daemon=True
-        self.frame = None
-        self.retrieve = self.video_capture.retrieve if isinstance(source,str) else self.video_capture.read
-        self.grab = self.video_capture.grab if isinstance(source,str) else lambda *args: None # Grab only if it is not PC webcam, otherwise do nothing
+        self.fps = fps
+        self.frame = None # Last frame returned, with its sequence number and grab time
+        self.seq = 0
+        self.readSeq = 0 # Newest sequence number returned or skipped (buffer mode may return an older, sharper frame)
+        self.frameTime = None
+        self.wanted = False # A reader waits for the next grabbed frame to be decoded
+        self.grabs = 0 # Statistics
+        self.grabFailures = 0
+        self.grabRate = 0. # Achieved grabs per second (moving average)
+        self.lastGrab = None
+        self.framesRead = 0
+        self.framesDropped = 0 # Grabbed but never returned (processing slower than the source)
+        self.buffer = buffer # Frames in the ring (0 = no ring, only the current frame)
+        self.ring = None # (buffer,H,W,3) frames, allocated at the first frame
+        self.times = np.zeros(buffer) # Grab time of each slot
+        self.scores = np.zeros(buffer) # Sharpness of each slot
+        self.seqs = np.full(buffer, -1, dtype=np.int64) # Sequence number of each slot, -1 while it is written
+        self.ready = Condition() # Protects frames and slots, notified at every new frame
+        self.stallTimeout = stallTimeout # Seconds without frames before reconnecting (0 = never)
+        self.maxDelay = maxDelay # Max seconds between reconnection attempts
+        self.state = 'closed' # 'connected', 'reconnecting' or 'connecting' (opened, waiting for the first frame)
+        self.aliveTime = time.monotonic() # Last frame or connection
+        self.delay = 1. # Wait before the next reconnection attempt, doubled at every failure
+        self.reconnects = 0
+        self.reconnectAttempts = 0
         
     def start(self):
         self.running = True
+        self.stopped.clear()
         self.t.start()
     
     def stop(self):
         self.running = False
+        self.stopped.set()
+        self.interrupt()
         self.t.join()
         return
         
     def loop(self):
+        if not isinstance(self.source,str) and not self.buffer: # Nothing to grab, the webcam is read on demand
+            self.stopped.wait()
+            return
+        deadline = time.monotonic()
         while(self.running):
-            self.grab() # Keep grabbing frames...
+            if self.state not in ('connected', 'connecting') and not self.reconnect():
+                break
+            period = 1. / self.fps # Known again after a reconnection
+            if self.decode() if self.buffer else self.grabFrame(): # Keep grabbing frames (live streams block until the next frame arrives)...
+                if self.live:
+                    continue
+            else:
+                self.grabFailures += 1 # Nothing to grab (e.g. end of file), wait a frame instead of spinning
+                if self.state == 'connecting' or self.stalled(): # New connection without frames, or stream dropped
+                    self.state = 'reconnecting'
+                    continue
+            deadline = max(deadline + period, time.monotonic() - period) # Files at their own FPS, catch up after slow grabs
+            self.stopped.wait(max(deadline - time.monotonic(), 0))
+
+    def stalled(self): # Live stream without frames for stallTimeout seconds
+        return bool(self.stallTimeout) and self.live and time.monotonic() - self.aliveTime > self.stallTimeout
+
+    def reconnect(self):
+        """
+        Grab thread: reopens the source, waiting 1, 2, 4... seconds (at most maxDelay) before each attempt. The source stays 'connecting'
+        until its first frame (see grabbed()): an attempt without frames counts as failed and the delay keeps growing. False if stopped meanwhile
+        """
+        with self.ready:
+            self.state = 'reconnecting' # interrupt() does nothing from now on
+        while self.running:
+            self.stopped.wait(self.delay)
+            self.delay = min(self.delay*2, self.maxDelay)
+            if not self.running:
+                break
+            self.reconnectAttempts += 1
+            try:
+                self.close()
+            except Exception:
+                pass
+            try:
+                self.open()
+            except (ValueError, OSError):
+                continue
+            with self.ready:
+                self.state = 'connecting'
+                self.aliveTime = time.monotonic() # Stall timeout of the new connection
+            return True
+        return False
+
+    def grabFrame(self): # Grab without decoding, unless a reader is waiting. VideoCapture is used by this thread only
+        if not self.grab():
+            return False
+        with self.ready:
+            self.grabbed()
+            if self.wanted:
+                ok, frame = self.retrieve()
+                if ok:
+                    self.frame, self.seq, self.frameTime = frame, self.grabs, self.lastGrab
+                    self.wanted = False
+                    self.ready.notify_all()
+        return True
+
+    def decode(self): # Buffer mode: decode the next frame in place, into the oldest slot of the ring
+        slot = self.grabs % self.buffer
+        with self.ready:
+            self.seqs[slot] = -1 # Not readable while it is overwritten
+        ok, frame = self.readFrame(None if self.ring is None else self.ring[slot])
+        if not ok:
+            return False
+        now = time.monotonic()
+        if self.ring is None or not np.may_share_memory(frame, self.ring): # First frame or new resolution
+            with self.ready:
+                self.ring = np.empty((self.buffer,)+frame.shape, dtype=frame.dtype)
+                self.seqs[:] = -1
+            self.ring[slot] = frame
+        score = sharpness(self.ring[slot])
+        with self.ready:
+            self.grabbed(now)
+            self.times[slot] = now
+            self.scores[slot] = score
+            self.seqs[slot] = self.grabs
+            self.ready.notify_all()
+        return True
+
+    def readFrame(self, out): # Decode the next frame, into out if possible
+        return self.video_capture.read() if out is None else self.video_capture.read(out)
+
+    def grabbed(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.lastGrab is not None:
+            self.grabRate += 0.1 * (1. / max(now - self.lastGrab, 1e-6) - self.grabRate)
+        self.lastGrab = now
+        self.aliveTime = now
+        self.grabs += 1
+        if self.state == 'connecting': # First frame of a new connection
+            self.state = 'connected'
+            self.reconnects += bool(self.reconnectAttempts) # Not the first connection
+            self.delay = 1.
+
+    def read(self, timeout=None):
+        """
+        Next frame not returned yet, as (frame, sequence number, monotonic grab time). Waits at most timeout (two frame periods by default),
+        frame is None if nothing new arrived
+        """
+        timeout = 2. / self.fps if timeout is None else timeout
+        last = self.readSeq
+        if self.state in ('connected', 'connecting') and self.stalled(): # Grab blocked on a dead stream: unblock it, the grab thread reconnects
+            self.interrupt()
+        if self.buffer:
+            frame = self.sharpest(timeout)
+        elif not isinstance(self.source,str): # Webcam, read on demand
+            ok, frame = self.retrieve()
+            if ok:
+                self.grabbed()
+                self.frame, self.seq, self.frameTime = frame, self.grabs, self.lastGrab
+                self.readSeq = self.seq
+        else:
+            with self.ready:
+                self.wanted = True # Decoded by the grab thread at the next grab
+                if not self.ready.wait_for(lambda: not self.wanted, timeout):
+                    self.wanted = False
+                frame = self.frame if self.seq != last else None
+                self.readSeq = self.seq
+        if frame is None:
+            return None, None, None
+        self.framesRead += 1
+        self.framesDropped += self.readSeq - last - 1
+        return self.flip(frame, 1), self.seq, self.frameTime
             
-    def get(self):
-        ret, self.frame = self.retrieve() #capture frame-by-frame
-        return self.flip(self.frame, 1)
+    def get(self): # Only the frame
+        return self.read()[0]
+
+    def pending(self): # Readable slots not returned yet, oldest first (call holding self.ready)
+        slots = np.flatnonzero(self.seqs > self.readSeq)
+        return slots[np.argsort(self.seqs[slots])]
+
+    def sharpest(self, timeout):
+        """
+        Buffer mode: copy of the sharpest frame grabbed since the last call, waiting at most timeout for a new one
+        """
+        with self.ready:
+            if not self.ready.wait_for(lambda: len(self.pending()), timeout):
+                return None
+            slots = self.pending()
+            slot = slots[np.argmax(self.scores[slots])]
+            self.frame = self.ring[slot].copy() # The only copy, the caller may keep or draw on it
+            self.seq = int(self.seqs[slot])
+            self.frameTime = float(self.times[slot])
+            self.readSeq = int(self.seqs[slots[-1]]) # The other pending frames are skipped too
+            return self.frame
+
+    def burst(self):
+        """
+        Buffer mode: copies of every frame grabbed since the last call, oldest first, as (frame, sequence number, grab time). Used to catch up after slow processing
+        """
+        with self.ready:
+            slots = self.pending()
+            if len(slots):
+                self.framesRead += len(slots)
+                self.framesDropped += int(self.seqs[slots[-1]]) - self.readSeq - len(slots) # Overwritten before this call
+                self.seq = self.readSeq = int(self.seqs[slots[-1]])
+                self.frameTime = float(self.times[slots[-1]])
+            return [ (self.flip(self.ring[slot].copy(), 1), int(self.seqs[slot]), float(self.times[slot])) for slot in slots ]
+
+    def stats(self):
+        return {
+            'captureFps': self.fps,
+            'grabRate': round(self.grabRate, 2),
+            'grabs': self.grabs,
+            'grabFailures': self.grabFailures,
+            'framesRead': self.framesRead,
+            'framesDropped': self.framesDropped,
+            'connected': int(self.state == 'connected'),
+            'reconnects': self.reconnects,
+            'reconnectAttempts': self.reconnectAttempts,
+        }
+
+
+
+def inputOptions(source): # ffmpeg/ffprobe options of the input, the same for probing and decoding
+    return ['-rtsp_transport', 'tcp'] if source.startswith('rtsp://') else []
+
+def probeStream(source, ffprobe='ffprobe', timeout=30): # (width, height, fps) of the first video stream, fps is None if unknown
+    try:
+        out = subprocess.run([ffprobe, '-v', 'error'] + inputOptions(source) + ['-select_streams', 'v:0', '-show_entries', 'stream=width,height,r_frame_rate', '-of', 'json', source],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout, check=True).stdout
+        stream = json.loads(out)['streams'][0]
+    except (subprocess.SubprocessError, ValueError, KeyError, IndexError):
+        raise ValueError('Cannot probe source!')
+    num, _, den = stream.get('r_frame_rate', '0/1').partition('/')
+    fps = float(num) / float(den or 1) if float(den or 1) else 0.
+    return int(stream['width']), int(stream['height']), fps if 0 < fps <= 240 else None
+
+# Capture through a local ffmpeg process writing raw BGR frames to a pipe: decode size, frame rate and threads are under our control.
+# Frames are read with readinto() straight into the slots of the ring (always at least 2), so no frame is allocated or copied by the reader
+class FFmpegCapture(Capture):
+    def __init__(self,source,fps=25,buffer=0,size=None,rate=None,threads=2,ffmpeg='ffmpeg',ffprobe='ffprobe',stallTimeout=0,maxDelay=60):
+        if not isinstance(source, str) or source.isdigit():
+            raise ValueError('FFmpeg capture needs a URL or a file!')
+        self.source = source
+        self.size = size # None = size of the stream, probed at every connection
+        self.rate = rate
+        self.defaultFps = fps
+        self.threads = threads
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.process = None
+        self.flip = lambda f, *a, **k: f
+        self.grab = None
+        self.live = '://' in source
+        self.setup(rate or fps, max(buffer, 2), stallTimeout, maxDelay) # The slot being read is never returned
+        try:
+            self.open()
+            self.state = 'connecting' if stallTimeout and self.live else 'connected' # Self-healing streams are connected at the first frame
+            self.aliveTime = time.monotonic() # Stall timeout from the end of open() (probing may take long)
+        except (ValueError, OSError):
+            if not (stallTimeout and self.live): # A stream that is down now is opened later by the grab thread
+                raise
+
+    def open(self):
+        if self.size:
+            width, height = self.size
+            sourceFps = None
+        else:
+            width, height, sourceFps = probeStream(self.source, self.ffprobe, self.stallTimeout or 30)
+        self.fps = self.rate or sourceFps or self.defaultFps
+        if self.ring is None or self.ring.shape[1:3] != (height, width): # Size is fixed by the scale filter
+            with self.ready:
+                self.ring = np.empty((self.buffer, height, width, 3), dtype=np.uint8)
+                self.seqs[:] = -1
+        command = [self.ffmpeg, '-nostdin', '-loglevel', 'error'] + inputOptions(self.source)
+        if self.source.startswith('rtsp://'):
+            command += ['-fflags', 'nobuffer', '-flags', 'low_delay'] # No latency from buffering
+        command += ['-threads', str(self.threads), '-i', self.source, '-an', '-vf', 'scale=%d:%d' % (width, height) + (',fps=%g' % self.rate if self.rate else ''),
+                    '-pix_fmt', 'bgr24', '-f', 'rawvideo', 'pipe:1']
+        self.process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, bufsize=0)
+
+    def close(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+
+    def interrupt(self): # Killing ffmpeg unblocks the reader
+        with self.ready:
+            if self.state in ('connected', 'connecting'):
+                self.process.kill()
+
+    def readFrame(self, out):
+        view = memoryview(out).cast('B') # The slot itself, as bytes
+        got = 0
+        while got < len(view): # A pipe may return partial frames
+            n = self.process.stdout.readinto(view[got:])
+            if not n: # ffmpeg exited
+                return False, None
+            got += n
+        return True, out
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        self.close() # Unblocks the reader
+        self.t.join()
+        self.close() # Started by a reconnection meanwhile
 
 
 
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os, time, json, shutil, threading
+import numpy as np
+
+def templatesToBlob(templates): # List of 128 measures -> float32 BLOB
+    return np.asarray(templates, dtype=np.float32).reshape(-1,FaceGallery.DIM).tobytes()
+
+def blobToTemplates(blob): # float32 BLOB -> (N,128) array, without copies
+    return np.frombuffer(blob, dtype=np.float32).reshape(-1,FaceGallery.DIM) if blob else np.empty((0,FaceGallery.DIM), dtype=np.float32)
+
+# Face templates packed in one contiguous matrix, so that a face is compared to every template with a single vectorized call
+class FaceGallery:
+    DIM = 128 # dlib descriptor size
+
+    def __init__(self, templates=None, targets=None, names=None):
+        self.templates = np.ascontiguousarray(templates if templates is not None else np.empty((0,self.DIM)), dtype=np.float32).reshape(-1,self.DIM) # (N,128) matrix
+        self.targets = np.asarray(targets if targets is not None else [], dtype=np.int64) # Target id of each template (parallel to templates)
+        self.names = dict(names) if names else {} # Target id -> target name
+        self.sqnorms = np.einsum('ij,ij->i', self.templates, self.templates) # Squared norms, computed once
+        self.index = None # Approximate index (see buildIndex), exact search if None
+        self.probes = 1
+
+    @classmethod
+    def fromBlobs(cls, targetFaces): # targetFaces rows are (id, templates BLOB, name)
+        names = {}
+        templates = []
+        targets = []
+        for row in targetFaces:
+            names[row[0]] = row[2]
+            t = blobToTemplates(row[1])
+            templates.append(t)
+            targets.append(np.full(len(t), row[0], dtype=np.int64))
+        templates = np.concatenate(templates) if templates else np.empty((0,cls.DIM), dtype=np.float32)
+        targets = np.concatenate(targets) if targets else np.empty(0, dtype=np.int64)
+        valid = np.any(templates, axis=1) # Avoid empty templates
+        return cls(templates[valid], targets[valid], names)
+
+    def save(self, directory): # Write the gallery as .npy files, to be memory-mapped by workers
+        np.save(os.path.join(directory, 'templates.npy'), self.templates)
+        np.save(os.path.join(directory, 'targets.npy'), self.targets)
+        np.save(os.path.join(directory, 'sqnorms.npy'), self.sqnorms)
+        if self.index is not None:
+            np.save(os.path.join(directory, 'centroids.npy'), self.index.centroids)
+            np.save(os.path.join(directory, 'offsets.npy'), self.index.offsets)
+        with open(os.path.join(directory, 'faces.json'), 'w') as f:
+            json.dump({'names': list(self.names.items()), 'probes': self.probes}, f)
+
+    @classmethod
+    def load(cls, directory): # Map a saved gallery read-only: memory is shared by every process
+        g = cls.__new__(cls)
+        g.templates = np.load(os.path.join(directory, 'templates.npy'), mmap_mode='r')
+        g.targets = np.load(os.path.join(directory, 'targets.npy'), mmap_mode='r')
+        g.sqnorms = np.load(os.path.join(directory, 'sqnorms.npy'), mmap_mode='r')
+        with open(os.path.join(directory, 'faces.json')) as f:
+            info = json.load(f)
+        g.names = { int(k): v for k, v in info['names'] }
+        g.probes = info['probes']
+        g.index = None
+        if os.path.isfile(os.path.join(directory, 'centroids.npy')):
+            g.index = IVFIndex(np.load(os.path.join(directory, 'centroids.npy')))
+            g.index.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        return g
+
+    def __len__(self):
+        return len(self.targets)
+
+    def buildIndex(self, probes, minTemplates, lists=0):
+        """
+        Builds the approximate (IVF) index if the gallery has at least minTemplates templates, otherwise keeps exact search.
+        Templates are reordered so that each inverted list is a contiguous slice of the matrix
+        """
+        self.index = None
+        self.probes = max(int(probes),1)
+        if len(self) < max(minTemplates,1):
+            return False
+        self.index = IVFIndex.train(self.templates, lists or int(np.sqrt(len(self))))
+        order = self.index.assign(self.templates)
+        self.templates = np.ascontiguousarray(self.templates[order])
+        self.targets = self.targets[order]
+        self.sqnorms = self.sqnorms[order]
+        return True
+
+    def distances(self, measures, start=0, stop=None):
+        """
+        Euclidean distances between one or more descriptors (M,128) and templates [start:stop], shape (M,N)
+        """
+        q = np.asarray(measures, dtype=np.float32).reshape(-1,self.DIM)
+        d = q @ self.templates[start:stop].T # ||q-t||^2 = ||q||^2 - 2 q.t + ||t||^2
+        d *= -2
+        d += self.sqnorms[start:stop]
+        d += np.einsum('ij,ij->i', q, q)[:,None]
+        np.maximum(d, 0, out=d) # Rounding may give tiny negative values
+        return np.sqrt(d, out=d)
+
+    def nearest(self, measures):
+        """
+        Index and distance of the nearest template (exact or approximate, depending on the index)
+        """
+        if self.index is None:
+            d = self.distances(measures)[0]
+            i = int(np.argmin(d))
+            return i, float(d[i])
+        best = -1
+        dist = np.inf
+        for start, stop in self.index.probe(measures, self.probes): # Only the closest lists are scanned
+            if stop > start:
+                d = self.distances(measures, start, stop)[0]
+                i = int(np.argmin(d))
+                if d[i] < dist:
+                    best = start + i
+                    dist = float(d[i])
+        return best, dist
+
+    def match(self, measures, maxDistance):
+        """
+        Best target for a single descriptor. Returns (targetId, name, distance), with targetId None if nothing is under maxDistance
+        """
+        if not len(self):
+            return None, None, 1.
+        i, dist = self.nearest(measures)
+        if dist < maxDistance:
+            targetId = int(self.targets[i])
+            return targetId, self.names.get(targetId), dist
+        return None, None, dist
+
+    def matchMany(self, measures, maxDistance):
+        """
+        Best targets for a batch of descriptors (e.g. all the faces of a frame), as a list of match() results
+        """
+        if self.index is not None or not len(self) or not len(measures):
+            return [ self.match(m, maxDistance) for m in measures ]
+        d = self.distances(np.array(measures, dtype=np.float32)) # (M,N) in one call
+        res = []
+        for i, dist in zip(np.argmin(d, axis=1), d.min(axis=1)):
+            dist = float(dist)
+            if dist < maxDistance:
+                targetId = int(self.targets[i])
+                res.append((targetId, self.names.get(targetId), dist))
+            else:
+                res.append((None, None, dist))
+        return res
+
+
+# Inverted file index: templates are partitioned with k-means and a query only scans the lists of its closest centroids
+class IVFIndex:
+    def __init__(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.csqnorms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.offsets = np.zeros(len(self.centroids)+1, dtype=np.int64) # List i is templates[offsets[i]:offsets[i+1]]
+
+    @classmethod
+    def train(cls, data, lists, iterations=10, sampleSize=64, seed=0):
+        rng = np.random.default_rng(seed)
+        lists = max(min(int(lists), len(data)),1)
+        sample = data[rng.choice(len(data), min(len(data), lists*sampleSize), replace=False)] # k-means on a sample only
+        index = cls(sample[rng.choice(len(sample), lists, replace=False)])
+        for _ in range(iterations):
+            labels = index.nearestLists(sample)
+            counts = np.bincount(labels, minlength=lists)
+            sums = np.zeros_like(index.centroids)
+            np.add.at(sums, labels, sample)
+            empty = counts == 0
+            sums[~empty] /= counts[~empty,None]
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))] # Restart empty clusters
+            index = cls(sums)
+        return index
+
+    def centroidDistances(self, data): # Squared distances to every centroid
+        q = np.asarray(data, dtype=np.float32).reshape(-1,self.centroids.shape[1])
+        return self.csqnorms - 2 * (q @ self.centroids.T) + np.einsum('ij,ij->i', q, q)[:,None]
+
+    def nearestLists(self, data, chunk=8192):
+        return np.concatenate([ np.argmin(self.centroidDistances(data[i:i+chunk]), axis=1) for i in range(0, len(data), chunk) ]) if len(data) else np.empty(0, dtype=np.int64)
+
+    def assign(self, data):
+        """
+        Assigns every template to a list. Returns the permutation that groups templates by list
+        """
+        labels = self.nearestLists(data)
+        self.offsets[1:] = np.cumsum(np.bincount(labels, minlength=len(self.centroids)))
+        return np.argsort(labels, kind='stable')
+
+    def probe(self, measures, probes):
+        d = self.centroidDistances(measures)[0]
+        probes = min(probes, len(d))
+        for l in np.argpartition(d, probes-1)[:probes]:
+            yield int(self.offsets[l]), int(self.offsets[l+1])
+
+
+# Snapshots are immutable directories, the "current" file points to the last published one.
+# Processes that already mapped an older snapshot keep using it safely.
+def newSnapshotDir(root):
+    directory = os.path.join(root, '%d_%d' % (time.time_ns(), os.getpid()))
+    os.makedirs(directory)
+    return directory
+
+def publishSnapshot(root, directory, keep=3):
+    tmp = os.path.join(root, 'current.%d.%d' % (os.getpid(), threading.get_ident())) # Never shared by two publishers
+    with open(tmp, 'w') as f:
+        f.write(os.path.basename(directory))
+    os.replace(tmp, os.path.join(root, 'current')) # Atomic
+    old = sorted( d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)) and d != os.path.basename(directory) )
+    for d in old[:max(len(old)-keep+1,0)]: # Remove older snapshots (already mapped files stay valid)
+        shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+
+def currentSnapshotDir(root):
+    with open(os.path.join(root, 'current')) as f:
+        return os.path.join(root, f.read().strip())
+
+# Polls the "current" pointer (at most every interval seconds) to detect a newly published snapshot
+class SnapshotWatcher:
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.version = None # Directory of the loaded snapshot
+        self.lastCheck = 0
+
+    def poll(self, force=False): # Returns the directory of a new snapshot, or None if nothing changed
+        now = time.monotonic()
+        if not force and now - self.lastCheck < self.interval:
+            return None
+        self.lastCheck = now
+        try:
+            directory = currentSnapshotDir(self.root)
+        except OSError:
+            return None
+        if directory != self.version:
+            self.version = directory
+            return directory
+        return None
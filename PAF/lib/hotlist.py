@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os, json
+import numpy as np
+
+from lib.plates import CONFUSIONS, normalizePlate, foldPlate, deletions, editDistance
+
+MAX_PLATE_LENGTH = 16 # Width of the packed plates (longer ones are cut)
+FOLD_TABLE = np.arange(256, dtype=np.uint8) # foldPlate() on bytes
+FOLD_TABLE[list(CONFUSIONS)] = list(CONFUSIONS.values())
+
+def packKeys(keys, width): # Strings -> fixed width bytes array (zero padded)
+    return np.array([ k.encode('ascii', 'replace')[:width] for k in keys ], dtype='S%d' % width)
+
+def hashKeys(keys, seed):
+    """
+    FNV-1a hash (64 bit) of every packed key. Same result in every process, unlike hash()
+    """
+    data = keys.view(np.uint8).reshape(len(keys), keys.dtype.itemsize)
+    h = np.full(len(keys), 0xcbf29ce484222325 ^ seed, dtype=np.uint64)
+    prime = np.uint64(0x100000001b3)
+    for col in data.T:
+        h ^= col
+        h *= prime
+    return h
+
+# Bloom filter backed by a NumPy bit array: fast "certainly not present" answers
+class BloomFilter:
+    def __init__(self, bits, hashes):
+        self.bits = bits # uint8 array
+        self.size = np.uint64(len(bits) * 8)
+        self.hashes = hashes
+
+    @classmethod
+    def build(cls, keys, bitsPerKey=10):
+        hashes = max(int(round(bitsPerKey * 0.69)), 1) # Optimal number of hash functions
+        bloom = cls(np.zeros(max(len(keys) * bitsPerKey // 8, 8), dtype=np.uint8), hashes)
+        bits = np.zeros(len(bloom.bits) * 8, dtype=bool) # One byte per bit while building, packed at the end
+        for p in bloom.positions(keys):
+            bits[p.astype(np.int64)] = True
+        bloom.bits = np.packbits(bits, bitorder='little') # Bit p is (bits[p >> 3] >> (p & 7)) & 1
+        return bloom
+
+    def positions(self, keys): # Double hashing: h1 + i*h2
+        h1 = hashKeys(keys, 0)
+        h2 = hashKeys(keys, 0x9e3779b97f4a7c15) | np.uint64(1)
+        for i in range(self.hashes):
+            yield (h1 + np.uint64(i) * h2) % self.size
+
+    def contains(self, keys): # Boolean array, False means certainly not present
+        res = np.ones(len(keys), dtype=bool)
+        for p in self.positions(keys):
+            res &= (self.bits[(p >> np.uint64(3)).astype(np.int64)] & (np.uint8(1) << (p & np.uint64(7)).astype(np.uint8))) != 0
+        return res
+
+# Target plates packed in sorted arrays and memory-mapped by every worker, so that memory does not grow with the hotlist.
+# A Bloom filter answers most negative reads, sorted arrays (binary search) confirm the positive ones.
+# Reads with confused characters or one edit are found through the one-deletion neighbourhood of the folded plates.
+class PlateHotlist:
+    FILES = ('plates', 'folded', 'targets', 'nameOffsets', 'names', 'keys', 'keyTargets', 'bloom')
+
+    def __init__(self, arrays, maxDistance=1, hashes=7):
+        self.maxDistance = min(maxDistance, 1) # The deletion index covers one edit
+        for name in self.FILES:
+            setattr(self, name, arrays[name])
+        self.width = self.plates.dtype.itemsize
+        self.filter = BloomFilter(self.bloom, hashes)
+
+    @classmethod
+    def build(cls, targetPlates, maxDistance=1, bitsPerKey=10): # targetPlates rows are (id, name, plate)
+        rows = sorted( (normalizePlate(r[2])[:MAX_PLATE_LENGTH], r[0], r[1] or '') for r in targetPlates if r[2] )
+        width = max([ len(r[0]) for r in rows ] + [1])
+        plates = packKeys([ r[0] for r in rows ], width)
+        folded = FOLD_TABLE[plates.view(np.uint8)].view('S%d' % width) # Plates are already normalized
+        names = [ r[2].encode('utf-8') for r in rows ]
+        keys = [folded] # Folded plates and their deletions, built column by column on the (N,width) byte matrix
+        keyTargets = [np.arange(len(rows), dtype=np.int64)]
+        if maxDistance:
+            matrix = folded.view(np.uint8).reshape(len(rows), width)
+            lengths = np.array([ len(r[0]) for r in rows ], dtype=np.int64)
+            for i in range(width):
+                rowsI = np.flatnonzero(lengths > i) # Deleting past the end gives the plate itself
+                deleted = np.zeros((len(rowsI), width), dtype=np.uint8)
+                deleted[:, :width-1] = np.delete(matrix[rowsI], i, axis=1)
+                keys.append(deleted.view('S%d' % width).ravel())
+                keyTargets.append(rowsI)
+        keys = np.concatenate(keys)
+        keyTargets = np.concatenate(keyTargets)
+        order = np.argsort(keys, kind='stable')
+        arrays = {
+            'plates': plates,
+            'folded': folded,
+            'targets': np.array([ r[1] for r in rows ], dtype=np.int64),
+            'nameOffsets': np.concatenate([[0], np.cumsum([ len(n) for n in names ], dtype=np.int64)]).astype(np.int64),
+            'names': np.frombuffer(b''.join(names), dtype=np.uint8),
+            'keys': keys[order],
+            'keyTargets': keyTargets[order],
+        }
+        bloom = BloomFilter.build(np.concatenate([plates, keys]) if len(plates) else plates, bitsPerKey)
+        arrays['bloom'] = bloom.bits
+        return cls(arrays, maxDistance, bloom.hashes)
+
+    def save(self, directory):
+        for name in self.FILES:
+            np.save(os.path.join(directory, 'plates_%s.npy' % name), getattr(self, name))
+        with open(os.path.join(directory, 'plates.json'), 'w') as f:
+            json.dump({'hashes': self.filter.hashes}, f)
+
+    @classmethod
+    def load(cls, directory, maxDistance=1): # Read-only memory maps
+        with open(os.path.join(directory, 'plates.json')) as f:
+            info = json.load(f)
+        arrays = { name: np.load(os.path.join(directory, 'plates_%s.npy' % name), mmap_mode='r') for name in cls.FILES }
+        return cls(arrays, maxDistance, info['hashes'])
+
+    def __len__(self):
+        return len(self.plates)
+
+    def name(self, i):
+        return bytes(self.names[self.nameOffsets[i]:self.nameOffsets[i+1]]).decode('utf-8')
+
+    def find(self, plate): # (targetId, name) or None
+        plate = normalizePlate(plate)
+        if not len(self) or len(plate) > self.width:
+            return None
+        key = packKeys([plate], self.width)
+        if not self.filter.contains(key)[0]: # Most reads stop here
+            return None
+        i = int(np.searchsorted(self.plates, key[0]))
+        if i < len(self.plates) and self.plates[i] == key[0]:
+            return int(self.targets[i]), self.name(i)
+        return None
+
+    def match(self, plate):
+        """
+        Target of a read: (targetId, name, distance), distance is 0 for exact or confused characters and 1 for one edit. None if not found
+        """
+        plate = normalizePlate(plate)
+        folded = foldPlate(plate)
+        queries = [ k for k in [plate] + list(deletions(folded) if self.maxDistance else [folded]) if len(k) <= self.width ]
+        if not len(self) or not queries:
+            return None
+        keys = packKeys(queries, self.width)
+        present = self.filter.contains(keys) # Single call for the exact and the fuzzy keys, most reads stop here
+        if queries[0] == plate and present[0]:
+            i = int(np.searchsorted(self.plates, keys[0]))
+            if i < len(self.plates) and self.plates[i] == keys[0]:
+                return int(self.targets[i]), self.name(i), 0
+        keys = keys[1:][present[1:]] if queries[0] == plate else keys[present]
+        best = None
+        for start, stop in zip(np.searchsorted(self.keys, keys, 'left'), np.searchsorted(self.keys, keys, 'right')):
+            for i in self.keyTargets[start:stop]:
+                d = editDistance(folded, self.folded[i].decode('ascii'), self.maxDistance)
+                if d is not None and (best is None or d < best[2]):
+                    best = (int(self.targets[i]), self.name(i), d)
+                    if d == 0:
+                        return best
+        return best
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+import cv2
+import numpy as np
+
+# Cheap motion detection on a small grayscale copy of the frame, used to skip recognition on static scenes
+class MotionGate:
+    def __init__(self, sensitivity, width=160, threshold=25, hold=2.0, alpha=0.1):
+        self.sensitivity = sensitivity # Min fraction of changed pixels (0 disables the gate)
+        self.width = width # Width of the analysed copy
+        self.threshold = threshold # Min intensity change of a pixel
+        self.hold = hold # Seconds the gate stays open after the last motion
+        self.alpha = alpha # Background adaptation speed
+        self.background = None
+        self.lastMotion = -np.inf
+        self.frames = 0 # Statistics
+        self.skipped = 0
+
+    def check(self, frame, now=None):
+        """
+        True if the frame has to be processed (motion now or in the last hold seconds)
+        """
+        self.frames += 1
+        if not self.sensitivity:
+            return True
+        now = time.monotonic() if now is None else now
+        height = max(int(frame.shape[0] * self.width / frame.shape[1]), 1)
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+        gray = cv2.GaussianBlur(gray, (5,5), 0).astype(np.float32)
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray
+            self.lastMotion = now # First frame is always processed
+            return True
+        diff = cv2.absdiff(gray, self.background)
+        cv2.accumulateWeighted(gray, self.background, self.alpha) # Follow slow light changes
+        if np.count_nonzero(diff > self.threshold) >= self.sensitivity * diff.size:
+            self.lastMotion = now
+        if now - self.lastMotion <= self.hold:
+            return True
+        self.skipped += 1
+        return False
@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os, threading, time, queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+def rotationMatrix(shape, angle):
+    """
+    Matrix and bounds (width, height) to rotate an image of the given shape (angle in degrees), expanding it to avoid cropping
+    """
+
+    height, width = shape[:2] # image shape has 3 dimensions
+    image_center = (width/2, height/2) # getRotationMatrix2D needs coordinates in reverse order (width, height) compared to shape
+
+    rotation_mat = cv2.getRotationMatrix2D(image_center, angle, 1.)
+
+    # rotation calculates the cos and sin, taking absolutes of those.
+    abs_cos = abs(rotation_mat[0,0])
+    abs_sin = abs(rotation_mat[0,1])
+
+    # find the new width and height bounds
+    bound_w = int(height * abs_sin + width * abs_cos)
+    bound_h = int(height * abs_cos + width * abs_sin)
+
+    # subtract old image center (bringing image back to origo) and adding the new image center coordinates
+    rotation_mat[0, 2] += bound_w/2 - image_center[0]
+    rotation_mat[1, 2] += bound_h/2 - image_center[1]
+    return rotation_mat, (bound_w, bound_h)
+
+def rotate_image(mat, angle, cache=None):
+    """
+    Rotates an image (angle in degrees) and expands image to avoid cropping.
+    With a RotationCache the result is written in a reused buffer (valid until the next rotation of the same shape and angle)
+    """
+    if cache is not None:
+        return cache.rotate(mat, angle)
+    rotation_mat, bounds = rotationMatrix(mat.shape, angle)
+    # rotate image with the new bounds and translated rotation matrix
+    return cv2.warpAffine(mat, rotation_mat, bounds)
+
+# Warp matrices and destination buffers per (shape, angle): camera resolution and rotations do not change, so the allocator is not churned
+class RotationCache:
+    def __init__(self, maxSize=64):
+        self.maxSize = maxSize
+        self.items = OrderedDict() # Least recently used first
+
+    def rotate(self, mat, angle):
+        key = (mat.shape, mat.dtype.str, angle)
+        item = self.items.get(key)
+        if item is None:
+            rotation_mat, bounds = rotationMatrix(mat.shape, angle)
+            item = (rotation_mat, bounds, np.empty((bounds[1], bounds[0]) + mat.shape[2:], dtype=mat.dtype))
+            self.items[key] = item
+            if len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+        else:
+            self.items.move_to_end(key)
+        rotation_mat, bounds, dst = item
+        return cv2.warpAffine(mat, rotation_mat, bounds, dst=dst)
+
+def plateCandidates(frame, maxCandidates=4, width=640):
+    """
+    Plate-like regions (x, y, w, h) found with edge density and morphology on a downscaled frame. Much cheaper than OpenALPR
+    """
+    scale = min(width / frame.shape[1], 1.)
+    small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else frame
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+    grad = cv2.convertScaleAbs(cv2.Sobel(gray, cv2.CV_16S, 1, 0, ksize=3)) # Characters give strong vertical edges
+    grad = cv2.GaussianBlur(grad, (5,5), 0)
+    _, mask = cv2.threshold(grad, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (17,3))) # Join characters
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (3,3))) # Remove noise
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    res = []
+    for c in contours:
+        x, y, w, h = cv2.boundingRect(c)
+        if w < 30 or h < 8 or not 1.5 <= w/h <= 8: # Plate shape (with some rotation)
+            continue
+        density = cv2.contourArea(c) / (w*h)
+        if density < 0.4:
+            continue
+        res.append((density*w*h, (int(x/scale), int(y/scale), int(w/scale), int(h/scale))))
+    res.sort(key=lambda r: r[0], reverse=True)
+    return [ r[1] for r in res[:maxCandidates] ]
+
+def resultRegions(plateRes): # Bounding boxes (x, y, w, h) of the plates found by OpenALPR (even if not confident)
+    res = []
+    for r in plateRes["results"] if plateRes else []:
+        xs = [ p["x"] for p in r["coordinates"] ]
+        ys = [ p["y"] for p in r["coordinates"] ]
+        res.append((min(xs), min(ys), max(xs)-min(xs), max(ys)-min(ys)))
+    return res
+
+def cropRegion(frame, region, pad=0.5, step=32):
+    """
+    Region with a margin, so that rotated plates are not cut. Sizes are rounded to step pixels, so that crops often share the same shape (see RotationCache)
+    """
+    x, y, w, h = region
+    cw = -(-int(w*(1+2*pad)) // step) * step
+    ch = -(-int(h*(1+2*pad) + w*0.4) // step) * step # Rotated plates grow in height
+    x1 = min(max(x + w//2 - cw//2, 0), max(frame.shape[1]-cw, 0))
+    y1 = min(max(y + h//2 - ch//2, 0), max(frame.shape[0]-ch, 0))
+    return frame[y1:y1+ch, x1:x1+cw]
+
+def bestResult(plateRes, minConfidence, useTemplates=False):
+    """
+    Candidates [(plate, confidence), ...] of the best result over minConfidence, [] if none. The plate chosen by OpenALPR comes first
+    (the best candidate matching the region pattern, if any). With useTemplates (a region is set) candidates not matching the pattern are dropped,
+    unless none matches
+    """
+    if plateRes and plateRes["results"] and plateRes["results"][0]["confidence"] > minConfidence:
+        r = plateRes["results"][0]
+        candidates = r.get("candidates") or [r]
+        if useTemplates and any( c.get("matches_template") for c in candidates ):
+            candidates = [ c for c in candidates if c.get("matches_template") ]
+        first = [ c for c in candidates if c["plate"] == r["plate"] ] or [r]
+        return [ (c["plate"], c["confidence"]) for c in first[:1] + [ c for c in candidates if c["plate"] != r["plate"] ] ]
+    return []
+
+CONFUSIONS = str.maketrans('OQDBIZSG', '00081256') # Characters OCR often confuses, folded to a single class
+
+def normalizePlate(text): # Uppercase, without whitespaces (as stored in targetPlates)
+    return ''.join(text.split()).upper()
+
+def foldPlate(plate): # Normalized plate with confusable characters in the same class (e.g. O and 0)
+    return normalizePlate(plate).translate(CONFUSIONS)
+
+def deletions(key): # Key and every string obtained deleting one character
+    return {key} | { key[:i] + key[i+1:] for i in range(len(key)) }
+
+def editDistance(a, b, maxDistance=1): # Levenshtein distance, None if greater than maxDistance
+    if abs(len(a) - len(b)) > maxDistance:
+        return None
+    prev = list(range(len(b)+1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j]+1, cur[j-1]+1, prev[j-1] + (ca != cb)))
+        if min(cur) > maxDistance:
+            return None
+        prev = cur
+    return prev[-1] if prev[-1] <= maxDistance else None
+
+# Skips OpenALPR on frames without plate-like regions, keeping statistics of its hit rate and of the time saved
+class PlatePrefilter:
+    def __init__(self, maxRegions=4, width=640):
+        self.maxRegions = maxRegions
+        self.width = width
+        self.frames = 0
+        self.passed = 0 # Frames with candidates, given to OpenALPR
+        self.filterTime = 0.
+        self.alprTime = 0. # OpenALPR time on passed frames (to estimate the time saved)
+
+    def regions(self, frame):
+        t = time.perf_counter()
+        regions = plateCandidates(frame, self.maxRegions, self.width)
+        self.filterTime += time.perf_counter() - t
+        self.frames += 1
+        self.passed += bool(regions)
+        return regions
+
+    def stats(self):
+        skipped = self.frames - self.passed
+        return {
+            'prefilterFrames': self.frames,
+            'prefilterHitRate': self.passed / self.frames if self.frames else 0,
+            'prefilterSkipped': skipped,
+            'prefilterTimeSaved': (self.alprTime / self.passed if self.passed else 0) * skipped - self.filterTime, # Seconds
+        }
+
+# OpenALPR instances of a process (one per thread at a time, OpenALPR is not thread safe) with a thread pool front end.
+# ctypes releases the GIL during recognition, so images are really OCRed concurrently.
+class AlprPool:
+    def __init__(self, newAlpr, size, instances=()):
+        self.newAlpr = newAlpr
+        self.size = max(size, 1)
+        self.created = 0
+        self.free = queue.LifoQueue() # Last used first: its memory is warm
+        for alpr in list(instances)[:self.size]:
+            self.free.put(alpr)
+            self.created += 1
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def acquire(self): # Free instance, a new one while less than size exist, otherwise waits
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return self.newAlpr()
+        return self.free.get()
+
+    def release(self, alpr):
+        self.free.put(alpr)
+
+    def recognize(self, image):
+        alpr = self.acquire()
+        try:
+            return alpr.recognize_ndarray(image)
+        finally:
+            self.release(alpr)
+
+    def map(self, fn, items): # fn(item) in the pool threads (fn uses recognize)
+        if self.size == 1:
+            return [ fn(i) for i in items ]
+        with self.lock:
+            if self.executor is None: # Threads are created in the process that uses them
+                self.executor = ThreadPoolExecutor(self.size)
+        return list(self.executor.map(fn, items))
+
+POOLS = {} # (process, key) -> AlprPool
+
+def alprPool(key, newAlpr, size, instances=()):
+    """
+    AlprPool of this process for the given configuration key, shared by every camera of the process with the same configuration
+    """
+    k = (os.getpid(), key) # Forked processes get their own pool
+    if k not in POOLS:
+        POOLS[k] = AlprPool(newAlpr, size, instances)
+    return POOLS[k]
+
+# Per-camera dedup: a plate seen again within window seconds does not produce a new event (bounded LRU of recent plates)
+class EventSuppressor:
+    def __init__(self, window, maxSize=1024):
+        self.window = window # 0 disables
+        self.maxSize = maxSize
+        self.seen = OrderedDict() # Normalized plate -> last time seen, oldest first
+        self.suppressed = 0
+        self.allowed = 0
+
+    def allow(self, plate, now):
+        plate = normalizePlate(plate)
+        last = self.seen.pop(plate, None)
+        self.seen[plate] = now # Window restarts at every sighting
+        if len(self.seen) > self.maxSize:
+            self.seen.popitem(last=False)
+        if last is not None and now - last < self.window:
+            self.suppressed += 1
+            return False
+        self.allowed += 1
+        return True
+
+    def stats(self):
+        return {'plateEvents': self.allowed, 'plateEventsSuppressed': self.suppressed}
+
+# Successful reads per rotation angle of a camera: the most likely angles are tried first and the useless ones are pruned
+class RotationStats:
+    def __init__(self, angles, hits=None, minHits=20, pruneShare=0.02, exploreEvery=50):
+        self.hits = { a: 0 for a in angles } # Configuration order is kept on ties
+        for a, h in (hits or {}).items():
+            if a in self.hits:
+                self.hits[a] = h
+        self.minHits = minHits # Hits needed before pruning
+        self.pruneShare = pruneShare # Angles with a smaller share of hits are pruned
+        self.exploreEvery = exploreEvery # Every this many retries all angles are tried, so that statistics can change
+        self.retries = 0
+
+    def angles(self): # Angles to try, in order
+        self.retries += 1
+        ordered = sorted(self.hits, key=lambda a: -self.hits[a])
+        total = sum(self.hits.values())
+        if total < self.minHits or self.retries % self.exploreEvery == 0:
+            return ordered
+        return [ a for a in ordered if self.hits[a] >= self.pruneShare * total ]
+
+    def hit(self, angle):
+        self.hits[angle] += 1
+
+# Plate search of a camera: a full frame pass first, then rotations only on plate candidate regions, evaluated concurrently
+class PlateReader:
+    def __init__(self, pool, rotations, minConfidence, maxRegions=4, prefilter=None, rotationStats=None, useTemplates=False):
+        self.pool = pool # AlprPool
+        self.useTemplates = useTemplates # Keep only candidates matching the region pattern (OpenALPR default region set)
+        self.prefilter = prefilter # PlatePrefilter or None
+        self.rotationStats = rotationStats # RotationStats (learned order) or None (fixed order)
+        self.rotations = list(rotations)
+        self.minConfidence = minConfidence
+        self.maxRegions = maxRegions
+        self.local = threading.local()
+
+    def threadCache(self):
+        if not hasattr(self.local, 'rotations'):
+            self.local.rotations = RotationCache()
+        return self.local.rotations
+
+    def recognizeVariant(self, variant): # Runs in a pool thread (with its own buffers)
+        crop, angle = variant
+        return bestResult(self.pool.recognize(rotate_image(crop, angle, self.threadCache())), self.minConfidence, self.useTemplates)
+
+    def readCandidates(self, frame):
+        """
+        Candidates [(plate, confidence), ...] of the best plate in the frame (see set_top_n), [] if none
+        """
+        regions = None
+        if self.prefilter:
+            regions = self.prefilter.regions(frame)
+            if not regions: # Nothing like a plate, OpenALPR is not needed
+                return []
+        t = time.perf_counter()
+        plateRes = self.pool.recognize(frame)
+        if self.prefilter:
+            self.prefilter.alprTime += time.perf_counter() - t
+        candidates = bestResult(plateRes, self.minConfidence, self.useTemplates)
+        if candidates or not self.rotations:
+            return candidates
+        if regions is None:
+            regions = plateCandidates(frame, self.maxRegions)
+        regions = resultRegions(plateRes) + regions # Plates found but not confident first
+        crops = [ cropRegion(frame, r) for r in regions[:self.maxRegions] ]
+        angles = self.rotationStats.angles() if self.rotationStats else self.rotations
+        variants = [ (crop, angle) for angle in angles for crop in crops ] # Most likely angles first
+        for i in range(0, len(variants), self.pool.size): # As many variants as threads concurrently, until a plate is found
+            chunk = variants[i:i+self.pool.size]
+            results = self.pool.map(self.recognizeVariant, chunk)
+            best = max(range(len(results)), key=lambda j: results[j][0][1] if results[j] else 0)
+            if results[best]:
+                if self.rotationStats:
+                    self.rotationStats.hit(chunk[best][1])
+                return results[best]
+        return []
+
+    def read(self, frame):
+        """
+        Best plate in the frame or None
+        """
+        candidates = self.readCandidates(frame)
+        return candidates[0][0] if candidates else None
+
+class PlateSession: # Reads of the same vehicle in consecutive frames
+    def __init__(self, now, frameTime):
+        self.votes = {} # Normalized plate -> sum of confidences
+        self.frames = 0
+        self.start = now
+        self.lastSeen = now
+        self.confidence = -1 # Confidence of the best frame
+        self.frame = None # Best frame (copy) and its time
+        self.frameTime = frameTime
+
+    def plate(self): # Voted plate
+        return max(self.votes, key=self.votes.get)
+
+# Accumulates plate candidates across consecutive frames and emits one consolidated event per vehicle
+class PlateVoter:
+    def __init__(self, maxGap=1.0, maxDuration=30.0, minFrames=1):
+        self.maxGap = maxGap # Seconds without reads that close a session (vehicle gone)
+        self.maxDuration = maxDuration # A parked vehicle produces an event at most every maxDuration seconds
+        self.minFrames = minFrames # Sessions with fewer frames are discarded
+        self.sessions = []
+
+    def add(self, candidates, now, frame, frameTime):
+        """
+        Adds the candidates [(plate, confidence), ...] of a frame to the session of the same vehicle (a new one if none shares a candidate)
+        """
+        if not candidates:
+            return
+        plates = [ (normalizePlate(p), c) for p, c in candidates ]
+        session = next(( s for s in self.sessions if any(p in s.votes for p, c in plates) ), None)
+        if session is None:
+            session = PlateSession(now, frameTime)
+            self.sessions.append(session)
+        for p, c in plates:
+            session.votes[p] = session.votes.get(p, 0) + c
+        session.frames += 1
+        session.lastSeen = now
+        if plates[0][1] > session.confidence: # Keep the best snapshot
+            session.confidence = plates[0][1]
+            session.frame = frame.copy()
+            session.frameTime = frameTime
+
+    def flush(self, now):
+        """
+        Closed sessions, to be saved as events. now must be on the clock given to add() (grab time of the last processed frame)
+        """
+        done = [ s for s in self.sessions if now - s.lastSeen > self.maxGap or now - s.start > self.maxDuration ]
+        self.sessions = [ s for s in self.sessions if s not in done ]
+        return [ s for s in done if s.frames >= self.minFrames ]
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+class Track:
+    def __init__(self, trackId, rect, now):
+        self.id = trackId
+        self.rect = rect # (left, top, right, bottom)
+        self.lastSeen = now
+        self.result = None # Last match result (targetId, name, distance)
+        self.verified = None # Time of the last descriptor computation
+
+    def needsDescriptor(self, now, reverify): # New track or time to verify it again
+        return self.result is None or now - self.verified >= reverify
+
+    def setResult(self, result, now): # Returns True if the identity of the track changed
+        changed = self.result is None or self.result[0] != result[0]
+        self.result = result
+        self.verified = now
+        return changed
+
+# Associates detected faces to the faces of the previous frames (IoU), so that descriptors are computed only for new people
+class FaceTracker:
+    def __init__(self, minIou=0.3, maxAge=1.0):
+        self.minIou = minIou
+        self.maxAge = maxAge # Seconds a track survives without detections
+        self.tracks = []
+        self.nextId = 0
+
+    def update(self, rects, now):
+        """
+        Returns the track of every rect (same order). Unmatched rects start a new track
+        """
+        self.tracks = [ t for t in self.tracks if now - t.lastSeen <= self.maxAge ]
+        res = [None]*len(rects)
+        if self.tracks and rects:
+            iou = boxIou(np.array(rects, dtype=np.float64), np.array([ t.rect for t in self.tracks ], dtype=np.float64))
+            for _ in range(min(len(rects), len(self.tracks))): # Greedy association, best overlap first
+                i, j = np.unravel_index(np.argmax(iou), iou.shape)
+                if iou[i,j] < self.minIou:
+                    break
+                res[i] = self.tracks[j]
+                iou[i,:] = -1
+                iou[:,j] = -1
+        for i, rect in enumerate(rects):
+            if res[i] is None:
+                res[i] = Track(self.nextId, rect, now)
+                self.nextId += 1
+                self.tracks.append(res[i])
+            res[i].rect = rect
+            res[i].lastSeen = now
+        return res
+
+    def reverify(self): # Targets changed: recognize again every face in view at its next detection, keeping its identity
+        for t in self.tracks:
+            t.verified = -np.inf
+
+def boxIou(a, b): # Intersection over union between every box of a (N,4) and b (M,4)
+    left = np.maximum(a[:,None,0], b[None,:,0])
+    top = np.maximum(a[:,None,1], b[None,:,1])
+    right = np.minimum(a[:,None,2], b[None,:,2])
+    bottom = np.minimum(a[:,None,3], b[None,:,3])
+    inter = np.clip(right-left, 0, None) * np.clip(bottom-top, 0, None)
+    areaA = (a[:,2]-a[:,0]) * (a[:,3]-a[:,1])
+    areaB = (b[:,2]-b[:,0]) * (b[:,3]-b[:,1])
+    return inter / np.maximum(areaA[:,None] + areaB[None,:] - inter, 1e-9)
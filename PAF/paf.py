@@ -6,7 +6,7 @@ PAF - Plate and Faces Recognition
 Pasquale Lafiosca (c) 2019
 """
 
-import sys, os, time, datetime
+import sys, os, time, datetime, functools
 from PyQt5 import QtCore, QtWidgets, uic
 from GUI import resources
 import json
@@ -20,7 +20,12 @@ import multiprocessing as mp
 import queue
 
 import settings # Local settings
-from lib.capture import Capture
+from lib.capture import Capture, FFmpegCapture
+from lib.tracker import FaceTracker
+from lib.motion import MotionGate
+from lib.plates import alprPool, PlateReader, PlatePrefilter, RotationStats, PlateVoter, EventSuppressor, normalizePlate
+from lib.hotlist import PlateHotlist
+from lib.gallery import FaceGallery, templatesToBlob, newSnapshotDir, publishSnapshot, currentSnapshotDir, SnapshotWatcher
 import openalpr
 
 # Global constants
@@ -28,10 +33,17 @@ import openalpr
 FACE_DETECTOR = dlib.get_frontal_face_detector() # Create a HOG face detector using the built-in dlib class
 FACE_POSE_PREDICTOR = dlib.shape_predictor(settings.SHAPE_PREDICTOR) # Getting landmarks
 FACE_RECOGNITION_MODEL = dlib.face_recognition_model_v1(settings.FACE_RECOGNITION_MODEL) # Getting 128 measures
-ALPR = openalpr.Alpr(settings.OPENALPR_COUNTRY, settings.OPENALPR_CONF, settings.OPENALPR_RUNTIME_DATA)
-if not ALPR.is_loaded():
-    raise ImportError("Error loading OpenALPR library.")
-ALPR.set_top_n(1) # Get only best result        
+def newAlpr(country=settings.OPENALPR_COUNTRY, region='', prewarp=''): # Each thread needs its own instance (see AlprPool)
+    alpr = openalpr.Alpr(country, settings.OPENALPR_CONF, settings.OPENALPR_RUNTIME_DATA)
+    if not alpr.is_loaded():
+        raise ImportError("Error loading OpenALPR library.")
+    alpr.set_top_n(settings.OPENALPR_TOP_N) # Candidates of the best result, voted across frames
+    if region: # Plate patterns of a region (e.g. "it")
+        alpr.set_default_region(region)
+    if prewarp: # Perspective correction of the camera (as given by openalpr-utils-calibrate)
+        alpr.set_prewarp(prewarp)
+    return alpr
+ALPR = newAlpr()
     
 class mainWindow(QtWidgets.QMainWindow):
     
@@ -104,6 +116,7 @@ class mainWindow(QtWidgets.QMainWindow):
             if c[3]:
                 plateProcesses+=1
             
+        buildSnapshot(DB) # Targets are loaded by the workers from disk
         #Pool initialization
         self.mainPool = mp.Pool(processes=max(backgroundProcesses,1)) # start worker processes for faces and plates
         for i, c in enumerate(cams):
@@ -116,6 +129,9 @@ class mainWindow(QtWidgets.QMainWindow):
         
         
         
+    def targetsChanged(self): # Publish a new targets snapshot, running workers pick it up between frames
+        buildSnapshot(DB)
+    
     def reInitializeProcesses(self): # RESTART
         if self.mainPool:
             self.mainPool.terminate()
@@ -444,6 +460,7 @@ class targetManager(QtWidgets.QWidget):
                 plateId = int(self.targetPlateList.item(e.row(), 0).text())
                 DB.execute("DELETE FROM targetPlates WHERE id=?", (plateId, ) )
                 self.targetPlateList.removeRow(e.row())
+            self.parent.targetsChanged()
             
     def deleteFace(self):
         selectedRows = self.targetFaceList.selectionModel().selectedRows()
@@ -455,6 +472,7 @@ class targetManager(QtWidgets.QWidget):
                 faceId = int(self.targetFaceList.item(e.row(), 0).text())
                 DB.execute("DELETE FROM targetFaces WHERE id=?", (faceId, ) )
                 self.targetFaceList.removeRow(e.row())    
+            self.parent.targetsChanged()
         
     def goBack(self):
         back = home(self.parent)
@@ -495,11 +513,11 @@ class addPlate(QtWidgets.QDialog):
                                     )
                                     
         if do:
-            plateText = self.plate.text().replace(" ", "").upper()
+            plateText = normalizePlate(self.plate.text())
             if self.curId is not None: # Update a previous row
                 DB.execute("UPDATE targetPlates SET name=?, plate=? WHERE id=?", (self.name.text(), plateText, self.curId) )
                 self.parent.loadPlateTargets() # refresh list
-                self.parent.parent.reInitializeProcesses()
+                self.parent.parent.targetsChanged()
                 self.close()
             else:
                 try:
@@ -512,7 +530,7 @@ class addPlate(QtWidgets.QDialog):
                                     )
                     return
                 self.parent.loadPlateTargets() # refresh list
-                self.parent.parent.reInitializeProcesses()
+                self.parent.parent.targetsChanged()
                 self.close()
                     
 class addFace(QtWidgets.QDialog):
@@ -527,7 +545,7 @@ class addFace(QtWidgets.QDialog):
         self.keepPreviousTemplate = False
         # Load current face info
         if faceId is not None:
-            res = DB.execute("SELECT name, faces FROM targetFaces WHERE id=(?) LIMIT 1", (faceId,)).fetchone()
+            res = DB.execute("SELECT name FROM targetFaces WHERE id=(?) LIMIT 1", (faceId,)).fetchone()
             self.curId = faceId
             self.name.setText(res[0])
             self.keepPreviousTemplate = True
@@ -572,23 +590,23 @@ class addFace(QtWidgets.QDialog):
                     else:
                         landmarks = FACE_POSE_PREDICTOR(img, rect[0]) # 68 landmarks
                         measures = np.array(FACE_RECOGNITION_MODEL.compute_face_descriptor(img, landmarks)) # 128 measures
-                        template.append(measures.tolist())
+                        template.append(measures)
             
             if self.curId is not None: # Update a previous row
                 if self.keepPreviousTemplate: # Update only name
                     DB.execute("UPDATE targetFaces SET name=? WHERE id=?", (self.name.text(), self.curId) )
                     self.parent.loadFaceTargets() # refresh list
-                    self.parent.parent.reInitializeProcesses()
+                    self.parent.parent.targetsChanged()
                     self.close()
                 elif template: # Update name and template
-                    DB.execute("UPDATE targetFaces SET name=?, faces=? WHERE id=?", (self.name.text(), json.dumps(template), self.curId) )
+                    DB.execute("UPDATE targetFaces SET name=?, templates=?, faces=NULL WHERE id=?", (self.name.text(), templatesToBlob(template), self.curId) )
                     self.parent.loadFaceTargets()
-                    self.parent.parent.reInitializeProcesses()
+                    self.parent.parent.targetsChanged()
                     self.close()
             elif template:  # Create a new row     
-                DB.execute("INSERT INTO targetFaces (name, faces) VALUES (?,?)", (self.name.text(), json.dumps(template)) )
+                DB.execute("INSERT INTO targetFaces (name, templates) VALUES (?,?)", (self.name.text(), templatesToBlob(template)) )
                 self.parent.loadFaceTargets()
-                self.parent.parent.reInitializeProcesses()
+                self.parent.parent.targetsChanged()
                 self.close()
             
 class about(QtWidgets.QWidget):
@@ -744,14 +762,6 @@ class analyzeThread(QtCore.QThread):
         else:
             roiValue = [None,None,None,None]
         
-        DB = sql.connect(settings.DB_PATH, isolation_level=None) # Open connection (automatically creates file if does not exist) in AUTOCOMMIT MODE
-        # Load Target Faces
-        targetFaces_data = DB.execute("SELECT id, faces, name FROM targetFaces").fetchall() # Load targetFaces data
-        targetFaces = [ [row[0], [np.array(t) for t in json.loads(row[1])], row[2] ] for row in targetFaces_data ] # Build a list and convert templates to JSON
-        
-        # Load Target Plates
-        targetPlates = DB.execute("SELECT id, name, plate FROM targetPlates").fetchall() # Load targetPlates data
-        
         imageOutputDir = os.path.join(os.path.dirname(self.output),os.path.splitext(os.path.basename(self.output))[0]+'_images')
         os.makedirs(imageOutputDir, exist_ok=True)
         csvfile = open(self.output, 'w')
@@ -779,7 +789,7 @@ class analyzeThread(QtCore.QThread):
         resQueue = manager.Queue() # Queue with returning rows
         # Start sub processes
         for i in range(numCpu):
-            pool.apply_async(processingFrame, args=(frameQueue, resQueue, targetFaces, targetPlates, self.doNewFaces, self.doNewPlates, imageOutputDir, roiValue), error_callback=self.workerError)
+            pool.apply_async(processingFrame, args=(frameQueue, resQueue, self.doNewFaces, self.doNewPlates, imageOutputDir, roiValue), error_callback=self.workerError)
             
         # Do processing
         for f in self.files:
@@ -848,7 +858,10 @@ class analyzeThread(QtCore.QThread):
         
 
 ################################## INNER FUNCTION START #################################
-def processingFrame(frameQueue, resQueue, targetFaces, targetPlates, doNewFaces, doNewPlates, imageOutputDir, roiValue):
+def processingFrame(frameQueue, resQueue, doNewFaces, doNewPlates, imageOutputDir, roiValue):
+    faceGallery, plateHotlist = loadSnapshot() # Shared memory-mapped targets
+    plateReader = PlateReader(alprPool('default', newAlpr, 1, [ALPR]), settings.OPENALPR_ROTATIONS, settings.OPENALPR_MIN_CONFIDENCE, settings.OPENALPR_MAX_REGIONS, # A single thread, there is already a process per CPU
+                              PlatePrefilter(settings.OPENALPR_MAX_REGIONS) if settings.PLATE_PREFILTER else None)
     while True:
         frameData = frameQueue.get() # Waits for frameData
         frame = frameData[0]
@@ -862,42 +875,28 @@ def processingFrame(frameQueue, resQueue, targetFaces, targetPlates, doNewFaces,
             frameName = filename+'_'+str(count)+'.png'
             frame = frame[roiValue[1]:roiValue[3],roiValue[0]:roiValue[2]] # Cut to ROI (if x1,y1,x2,y2 are None, frame remains the same)
             # FACE RECOGNITION
-            detected_faces = FACE_DETECTOR(frame, 1) # Detect faces (quite slow)
+            detected_faces = detectFaces(frame, settings.FACE_DETECT_SCALE, settings.FACE_DETECT_UPSAMPLE, settings.FACE_MIN_SIZE) # Detect faces (quite slow)
             if len(detected_faces)>0:
-                for i, rect in enumerate(detected_faces): # For every detected face
-                    ########### SLOW PART > 0.3 s per face ##########
-                    landmarks = FACE_POSE_PREDICTOR(frame, rect) # Get 68 points
-                    measures = FACE_RECOGNITION_MODEL.compute_face_descriptor(frame, landmarks) # Get 128 measures
-                    ########### SLOW PART END ##############
-                    dist = 1 # Distance
-                    bestMatch = None # Best match found
-                    for t in targetFaces: # For every target in database
-                        for f in t[1]: # In every template
-                            if any(f): # Avoid empty templates
-                                new_dist = np.linalg.norm(measures - f)
-                                if new_dist < settings.MAX_DISTANCE and new_dist < dist:
-                                    dist = new_dist # Update best match
-                                    bestMatch = t
+                ########### SLOW PART > 0.3 s per face ##########
+                descriptors = computeDescriptors(frame, detected_faces) # Every face of the frame in one call
+                ########### SLOW PART END ##############
+                for rect, (bestMatch, bestName, dist) in zip(detected_faces, faceGallery.matchMany(descriptors, settings.MAX_DISTANCE)): # For every detected face
                     if bestMatch is not None:
                         saveFrame = True
                         cv2.rectangle(frame, (rect.left(), rect.top()), (rect.left()+rect.width(), rect.top()+rect.height()), (0, 0, 255), 2) # Draw RED rectangle around the faces
-                        cv2.putText(frame, bestMatch[2],(rect.left(),rect.top()), cv2.FONT_HERSHEY_TRIPLEX, fontScale=1, color=(0, 0, 255), thickness=2)
+                        cv2.putText(frame, bestName,(rect.left(),rect.top()), cv2.FONT_HERSHEY_TRIPLEX, fontScale=1, color=(0, 0, 255), thickness=2)
                         cv2.putText(frame,"{:.0%}".format(1-dist),(rect.left(),rect.bottom()), cv2.FONT_HERSHEY_TRIPLEX, fontScale=1, color=(0, 0, 255), thickness=1)
-                        output.append([filename, humanize_time(count/fps), 'F', t[2], '', frameName])
+                        output.append([filename, humanize_time(count/fps), 'F', bestName, '', frameName])
                     elif doNewFaces:
                         saveFrame = True
                         cv2.rectangle(frame, (rect.left(), rect.top()), (rect.left()+rect.width(), rect.top()+rect.height()), (0, 255, 0), 2) # Draw GREEN rectangle around the faces
                         output.append([filename, humanize_time(count/fps), 'F', '', '', frameName])
                         
             # PLATE RECOGNITION
-            bestPlate = searchBestPlate(frame, ALPR)
+            bestPlate = plateReader.read(frame)
             if bestPlate:
-                bestPlate = bestPlate.upper()
-                targetData = None
-                for tar in targetPlates: # Search in targets
-                    if bestPlate == tar[2].upper():
-                        targetData = tar
-                        break
+                bestPlate = normalizePlate(bestPlate)
+                targetData = plateHotlist.match(bestPlate) # Search in targets (tolerant to OCR errors)
                 # Save to db
                 if targetData:
                     output.append([filename, humanize_time(count/fps), 'P', targetData[1], bestPlate, frameName])
@@ -919,11 +918,23 @@ def processingFrame(frameQueue, resQueue, targetFaces, targetPlates, doNewFaces,
 # Main separate recognition process
 def recognitionProcess(camId):
     DB = sql.connect(settings.DB_PATH, isolation_level=None) # Open connection (automatically creates file if does not exist) in AUTOCOMMIT MODE
-    cam = DB.execute("SELECT url, saveNewFaces, saveNewPlates, activeFace, activePlate, roi FROM cameras WHERE id = ?", (camId,) ).fetchone()
+    cam = DB.execute("SELECT url, saveNewFaces, saveNewPlates, activeFace, activePlate, roi, detectScale, detectUpsample, minFaceSize, motionSensitivity, alprCountry, alprRegion, alprPrewarp, useRotations, plateSuppressSeconds, captureBuffer, captureBackend, captureSize, captureFps FROM cameras WHERE id = ?", (camId,) ).fetchone()
     saveNewFaces = cam[1]
     saveNewPlates = cam[2]
     doFace = cam[3]
     doPlate = cam[4]
+    detectScale = cam[6] or settings.FACE_DETECT_SCALE
+    detectUpsample = cam[7] if cam[7] is not None else settings.FACE_DETECT_UPSAMPLE
+    minFaceSize = cam[8] or settings.FACE_MIN_SIZE
+    rotationStats = RotationStats(settings.OPENALPR_ROTATIONS, dict(DB.execute("SELECT angle, hits FROM plateRotations WHERE camera = ?", (camId,)).fetchall()),
+                                  settings.ROTATION_MIN_HITS, settings.ROTATION_PRUNE_SHARE, settings.ROTATION_EXPLORE_EVERY) # Learned by previous runs too
+    alprConfig = (cam[10] or settings.OPENALPR_COUNTRY, cam[11] or '', cam[12] or '') # Country, region and prewarp of this camera
+    pool = alprPool(alprConfig, functools.partial(newAlpr, *alprConfig), settings.OPENALPR_THREADS, [ALPR] if alprConfig == (settings.OPENALPR_COUNTRY, '', '') else [])
+    plateReader = PlateReader(pool, settings.OPENALPR_ROTATIONS if cam[13] else [], settings.OPENALPR_MIN_CONFIDENCE, settings.OPENALPR_MAX_REGIONS, # Prewarped cameras may not need rotations
+                              PlatePrefilter(settings.OPENALPR_MAX_REGIONS) if settings.PLATE_PREFILTER else None, rotationStats, bool(alprConfig[1])) # Region pattern filters candidates
+    plateSuppressor = EventSuppressor(cam[14] if cam[14] is not None else settings.PLATE_SUPPRESS_SECONDS, settings.PLATE_SUPPRESS_SIZE)
+    plateVoter = PlateVoter(settings.PLATE_VOTE_MAX_GAP, settings.PLATE_VOTE_MAX_DURATION, settings.PLATE_VOTE_MIN_FRAMES)
+    motionGate = MotionGate(cam[9] or 0, settings.MOTION_WIDTH, settings.MOTION_THRESHOLD, settings.MOTION_HOLD)
     if cam[5]: # Show ROI
         r = [int(s) for s in cam[5].split() if s.isdigit()]
         x1 = r[0]
@@ -936,76 +947,107 @@ def recognitionProcess(camId):
         x2 = None
         y2 = None
         
-    cap = Capture(source=cam[0])
+    captureBuffer = cam[15] if cam[15] is not None else settings.CAPTURE_BUFFER # With a buffer, the sharpest frame since the last one processed
+    if cam[16] == 'ffmpeg': # Decoded by a local ffmpeg process, at the requested size and frame rate
+        cap = FFmpegCapture(cam[0], settings.CAPTURE_DEFAULT_FPS, captureBuffer, tuple(int(v) for v in cam[17].lower().split('x')) if cam[17] else None, cam[18],
+                            settings.FFMPEG_THREADS, settings.FFMPEG_PATH, settings.FFPROBE_PATH, settings.CAPTURE_STALL_TIMEOUT, settings.CAPTURE_RECONNECT_MAX_DELAY)
+    else:
+        cap = Capture(source=cam[0], fps=settings.CAPTURE_DEFAULT_FPS, buffer=captureBuffer, stallTimeout=settings.CAPTURE_STALL_TIMEOUT, maxDelay=settings.CAPTURE_RECONNECT_MAX_DELAY) # Dropped streams are reopened
     cap.start()
     
     savePath = os.path.join(settings.EVENTS_PATH, str(camId))
     os.makedirs(savePath, exist_ok=True)
     
-    # Load Target Faces
-    targetFaces_data = DB.execute("SELECT id, faces, name FROM targetFaces").fetchall() # Load targetFaces data
-    targetFaces = [ [row[0], [np.array(t) for t in json.loads(row[1])], row[2] ] for row in targetFaces_data ] # Build a list and convert templates to JSON
-    
-    # Load Target Plates
-    targetPlates = DB.execute("SELECT id, name, plate FROM targetPlates").fetchall() # Load targetPlates data
+    # Load Target Faces and Plates
+    targetsWatcher = SnapshotWatcher(settings.GALLERY_PATH, settings.TARGETS_POLL_INTERVAL)
+    faceGallery, plateHotlist = loadSnapshot(targetsWatcher.poll(force=True)) # Shared memory-mapped targets
+    faceTracker = FaceTracker(settings.FACE_TRACK_MIN_IOU, settings.FACE_TRACK_MAX_AGE)
     
     
+    burst = [] # Buffered frames still to process while there is motion
+    catchUp = False
+    voterTime = None # Grab time of the last processed frame: sessions are closed on the frame clock (None = no frames processed)
+    lastStats = time.monotonic()
     while(True):
-        frame = cap.get()
-        frameTime = datetime.datetime.now()
+        if time.monotonic() - lastStats > settings.STATS_INTERVAL:
+            lastStats = time.monotonic()
+            if plateReader.prefilter:
+                saveStats(DB, camId, plateReader.prefilter.stats())
+            saveStats(DB, camId, plateSuppressor.stats())
+            saveStats(DB, camId, cap.stats())
+            DB.executemany("INSERT OR REPLACE INTO plateRotations (camera, angle, hits) VALUES (?,?,?)", [ (camId, a, h) for a, h in rotationStats.hits.items() ])
+        newTargets = targetsWatcher.poll() # Targets changed? Reload them keeping the stream open
+        if newTargets:
+            try:
+                faceGallery, plateHotlist = loadSnapshot(newTargets)
+                faceTracker.reverify() # Match again faces already in view, new events only if their identity changes
+            except OSError: # Snapshot replaced meanwhile, retry at next poll
+                targetsWatcher.version = None
+        for session in plateVoter.flush(voterTime if voterTime is not None else time.monotonic()): # One event per vehicle, with the voted plate. Slow frames do not close sessions
+            bestPlate = session.plate()
+            if not plateSuppressor.allow(bestPlate, time.monotonic()): # Same plate seen a short time ago
+                continue
+            targetData = plateHotlist.match(bestPlate) # Search in targets (tolerant to OCR errors)
+            # Save to db
+            if targetData:
+                DB.execute("INSERT INTO eventPlates (camera, datetime, plate, target, distance) VALUES (?,?,?,?,?)", (camId, session.frameTime.strftime('%Y%m%d%H%M%S%f'), bestPlate, targetData[0], targetData[2]) )
+            elif saveNewPlates:
+                DB.execute("INSERT INTO eventPlates (camera, datetime, plate) VALUES (?,?,?)", (camId, session.frameTime.strftime('%Y%m%d%H%M%S%f'), bestPlate) )
+            else:
+                continue
+            cv2.imwrite( os.path.join(savePath,session.frameTime.strftime('%Y%m%d%H%M%S%f.png')), session.frame ) # Best frame of the vehicle
+        if catchUp and not burst:
+            burst = cap.burst()
+        frame, seq, grabTime = burst.pop(0) if burst else cap.read() # Only frames not processed yet (waits for the next one)
+        voterTime = None # Idle (stream down or static scene) until this frame is processed
         if frame is not None:
+            frameTime = datetime.datetime.now() - datetime.timedelta(seconds=time.monotonic() - grabTime) # When the frame was grabbed, not processed
             frame = frame[y1:y2,x1:x2] # Cut to ROI (if x1,y1,x2,y2 are None, frame remains the same)
+            moving = motionGate.check(frame, grabTime)
+            catchUp = bool(captureBuffer and motionGate.sensitivity and moving) # From motion start to its end, every buffered frame is processed (oldest first), not only the sharpest
+            if not moving: # Nothing changed, skip faces and plates
+                burst = []
+                continue
             saveFrame = False
             # FACE RECOGNITION
             if doFace:
-                detected_faces = FACE_DETECTOR(frame, 1) # Detect faces (quite slow)
+                detected_faces = detectFaces(frame, detectScale, detectUpsample, minFaceSize) # Detect faces (quite slow)
                 if len(detected_faces)>0:
-                    for i, rect in enumerate(detected_faces): # For every detected face
+                    now = grabTime
+                    tracks = faceTracker.update([ (r.left(), r.top(), r.right(), r.bottom()) for r in detected_faces ], now) # Same people of previous frames?
+                    toVerify = [ i for i, t in enumerate(tracks) if t.needsDescriptor(now, settings.FACE_TRACK_REVERIFY) ] # New faces or periodic verification
+                    newEvents = set()
+                    if toVerify:
                         ########### SLOW PART > 0.3 s per face ##########
-                        landmarks = FACE_POSE_PREDICTOR(frame, rect) # Get 68 points
-                        measures = FACE_RECOGNITION_MODEL.compute_face_descriptor(frame, landmarks) # Get 128 measures
+                        descriptors = computeDescriptors(frame, [ detected_faces[i] for i in toVerify ]) # Every face of the frame in one call
                         ########### SLOW PART END ##############
-                        dist = 1 # Distance
-                        bestMatch = None # Best match found
-                        for t in targetFaces: # For every target in database
-                            for f in t[1]: # In every template
-                                if any(f): # Avoid empty templates
-                                    new_dist = np.linalg.norm(measures - f)
-                                    if new_dist < settings.MAX_DISTANCE and new_dist < dist:
-                                        dist = new_dist # Update best match
-                                        bestMatch = t
+                        for i, result in zip(toVerify, faceGallery.matchMany(descriptors, settings.MAX_DISTANCE)):
+                            if tracks[i].setResult(result, now):
+                                newEvents.add(i)
+                    for i, (rect, track) in enumerate(zip(detected_faces, tracks)): # For every detected face
+                        newEvent = i in newEvents
+                        bestMatch, bestName, dist = track.result # Reuse the result for the rest of the track
                         if bestMatch is not None:
-                            saveFrame = True
                             cv2.rectangle(frame, (rect.left(), rect.top()), (rect.left()+rect.width(), rect.top()+rect.height()), (0, 0, 255), 2) # Draw RED rectangle around the faces
-                            cv2.putText(frame, bestMatch[2],(rect.left(),rect.top()), cv2.FONT_HERSHEY_TRIPLEX, fontScale=1, color=(0, 0, 255), thickness=2)
+                            cv2.putText(frame, bestName,(rect.left(),rect.top()), cv2.FONT_HERSHEY_TRIPLEX, fontScale=1, color=(0, 0, 255), thickness=2)
                             cv2.putText(frame,"{:.0%}".format(1-dist),(rect.left(),rect.bottom()), cv2.FONT_HERSHEY_TRIPLEX, fontScale=1, color=(0, 0, 255), thickness=1)
-                            DB.execute("INSERT INTO eventFaces (camera, datetime, target) VALUES (?,?,?)", (camId, frameTime.strftime('%Y%m%d%H%M%S%f'), bestMatch[0]) )
+                            if newEvent: # One event per track (or identity change)
+                                saveFrame = True
+                                DB.execute("INSERT INTO eventFaces (camera, datetime, target) VALUES (?,?,?)", (camId, frameTime.strftime('%Y%m%d%H%M%S%f'), bestMatch) )
                         elif saveNewFaces:
-                            saveFrame = True
                             cv2.rectangle(frame, (rect.left(), rect.top()), (rect.left()+rect.width(), rect.top()+rect.height()), (0, 255, 0), 2) # Draw GREEN rectangle around the faces
-                            DB.execute("INSERT INTO eventFaces (camera, datetime) VALUES (?,?)", (camId, frameTime.strftime('%Y%m%d%H%M%S%f')) )
+                            if newEvent:
+                                saveFrame = True
+                                DB.execute("INSERT INTO eventFaces (camera, datetime) VALUES (?,?)", (camId, frameTime.strftime('%Y%m%d%H%M%S%f')) )
                 
             # PLATE RECOGNITION
             if doPlate:
-                bestPlate = searchBestPlate(frame, ALPR)
-                if bestPlate:
-                    bestPlate = bestPlate.upper()
-                    idTarget = None
-                    for tar in targetPlates: # Search in targets
-                        if bestPlate == tar[2].upper():
-                            idTarget = tar[0]
-                            break
-                    # Save to db
-                    if idTarget:
-                        DB.execute("INSERT INTO eventPlates (camera, datetime, plate, target) VALUES (?,?,?,?)", (camId, frameTime.strftime('%Y%m%d%H%M%S%f'), bestPlate, idTarget) )
-                        saveFrame = True
-                    elif saveNewPlates:
-                        DB.execute("INSERT INTO eventPlates (camera, datetime, plate) VALUES (?,?,?)", (camId, frameTime.strftime('%Y%m%d%H%M%S%f'), bestPlate) )
-                        saveFrame = True
+                plateVoter.add(plateReader.readCandidates(frame), grabTime, frame, frameTime) # Votes across frames, events are saved when the vehicle is gone
                     
             if saveFrame:    
                 # Save image in folder too!        
                 cv2.imwrite( os.path.join(savePath,frameTime.strftime('%Y%m%d%H%M%S%f.png')), frame )
+            voterTime = grabTime
             
     
         
@@ -1016,49 +1058,87 @@ def centerOnScreen(w): # Centers the window on the screen
               (resolution.height() / 2) - (w.frameSize().height() / 2))
     w.setFixedSize(w.size()) # Fixed dimensions (how to be responsive?)
 
-def humanize_time(secs):
-    mins, secs = divmod(secs, 60)
-    hours, mins = divmod(mins, 60)
-    return '%02d:%02d:%02d' % (hours, mins, secs)
+def buildSnapshot(DB): # Write targets on disk once, every worker maps them read-only
+    targetFaces_data = DB.execute("SELECT id, templates, name FROM targetFaces").fetchall() # Load targetFaces data (templates are float32 BLOBs)
+    faceGallery = FaceGallery.fromBlobs(targetFaces_data)
+    faceGallery.buildIndex(settings.FACE_INDEX_PROBES, settings.FACE_INDEX_MIN_TEMPLATES, settings.FACE_INDEX_LISTS) # Approximate search only on big galleries
+    targetPlates = DB.execute("SELECT id, name, plate FROM targetPlates").fetchall() # Load targetPlates data
+    directory = newSnapshotDir(settings.GALLERY_PATH)
+    faceGallery.save(directory)
+    PlateHotlist.build(targetPlates, settings.PLATE_MAX_DISTANCE, settings.PLATE_BLOOM_BITS).save(directory) # Sorted arrays and Bloom filter
+    publishSnapshot(settings.GALLERY_PATH, directory)
+
+def loadSnapshot(directory=None): # Returns faceGallery and plateHotlist from a snapshot (the current one by default)
+    directory = directory or currentSnapshotDir(settings.GALLERY_PATH)
+    faceGallery = FaceGallery.load(directory)
+    plateHotlist = PlateHotlist.load(directory, settings.PLATE_MAX_DISTANCE)
+    return faceGallery, plateHotlist
 
-def rotate_image(mat, angle):
+def detectFaces(frame, scale=1., upsample=1, minSize=0):
     """
-    Rotates an image (angle in degrees) and expands image to avoid cropping
+    HOG face detection on a resized copy of the frame. Rectangles are mapped back to full resolution
     """
+    if scale == 1:
+        detected = FACE_DETECTOR(frame, upsample)
+    else:
+        detected = FACE_DETECTOR(cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), upsample)
+    rects = dlib.rectangles()
+    for r in detected:
+        rect = dlib.rectangle(int(r.left()/scale), int(r.top()/scale), int(r.right()/scale), int(r.bottom()/scale))
+        if rect.width() >= minSize and rect.height() >= minSize:
+            rects.append(rect)
+    return rects
 
-    height, width = mat.shape[:2] # image shape has 3 dimensions
-    image_center = (width/2, height/2) # getRotationMatrix2D needs coordinates in reverse order (width, height) compared to shape
+def computeDescriptors(frame, rects): # 128 measures of every face, with a single batched call to the model
+    shapes = dlib.full_object_detections()
+    for rect in rects:
+        shapes.append(FACE_POSE_PREDICTOR(frame, rect)) # Get 68 points
+    return FACE_RECOGNITION_MODEL.compute_face_descriptor(frame, shapes)
 
-    rotation_mat = cv2.getRotationMatrix2D(image_center, angle, 1.)
+def humanize_time(secs):
+    mins, secs = divmod(secs, 60)
+    hours, mins = divmod(mins, 60)
+    return '%02d:%02d:%02d' % (hours, mins, secs)
 
-    # rotation calculates the cos and sin, taking absolutes of those.
-    abs_cos = abs(rotation_mat[0,0]) 
-    abs_sin = abs(rotation_mat[0,1])
+SCHEMA_TABLES = [ # Tables added to the original database
+    "CREATE TABLE IF NOT EXISTS cameraStats (camera INTEGER, name TEXT, value REAL, PRIMARY KEY(camera, name))", # Statistics of the camera workers
+    "CREATE TABLE IF NOT EXISTS plateRotations (camera INTEGER, angle REAL, hits INTEGER, PRIMARY KEY(camera, angle))", # Learned plate rotations
+]
 
-    # find the new width and height bounds
-    bound_w = int(height * abs_sin + width * abs_cos)
-    bound_h = int(height * abs_cos + width * abs_sin)
+SCHEMA_COLUMNS = [ # Columns added to the original database: (table, column, definition)
+    ('targetFaces', 'templates', 'BLOB'), # Templates as float32 BLOB instead of JSON text
+    ('cameras', 'detectScale', 'REAL'), # Face detection on a resized copy of the frame (NULL = settings.FACE_DETECT_SCALE)
+    ('cameras', 'detectUpsample', 'INTEGER'), # HOG detector upsampling (NULL = settings.FACE_DETECT_UPSAMPLE)
+    ('cameras', 'minFaceSize', 'INTEGER DEFAULT 0'), # Smaller faces (pixels) are ignored
+    ('cameras', 'motionSensitivity', 'REAL DEFAULT 0'), # Min fraction of changed pixels to run recognition (0 = always)
+    ('eventPlates', 'distance', 'INTEGER'), # Edits between the read plate and the target plate
+    ('cameras', 'alprCountry', 'TEXT'), # OpenALPR country (NULL = settings.OPENALPR_COUNTRY)
+    ('cameras', 'alprRegion', 'TEXT'), # OpenALPR default region
+    ('cameras', 'alprPrewarp', 'TEXT'), # OpenALPR prewarp (perspective correction)
+    ('cameras', 'useRotations', 'INTEGER DEFAULT 1'), # Retry plates with settings.OPENALPR_ROTATIONS
+    ('cameras', 'plateSuppressSeconds', 'REAL'), # No new event for a plate seen again within this time (NULL = settings.PLATE_SUPPRESS_SECONDS)
+    ('cameras', 'captureBuffer', 'INTEGER'), # Frames in the capture ring buffer (NULL = settings.CAPTURE_BUFFER, 0 = current frame only)
+    ('cameras', 'captureBackend', "TEXT DEFAULT 'opencv'"), # 'opencv' or 'ffmpeg'
+    ('cameras', 'captureSize', 'TEXT'), # Decode size of the ffmpeg backend, e.g. '1280x720' (NULL = size of the stream)
+    ('cameras', 'captureFps', 'REAL'), # Frame rate of the ffmpeg backend, extra frames are dropped by ffmpeg (NULL = all the frames)
+]
 
-    # subtract old image center (bringing image back to origo) and adding the new image center coordinates
-    rotation_mat[0, 2] += bound_w/2 - image_center[0]
-    rotation_mat[1, 2] += bound_h/2 - image_center[1]
+def saveStats(DB, camId, stats): # Statistics of a camera worker, readable from the cameraStats table
+    DB.executemany("INSERT OR REPLACE INTO cameraStats (camera, name, value) VALUES (?,?,?)", [ (camId, k, v) for k, v in stats.items() ])
 
-    # rotate image with the new bounds and translated rotation matrix
-    rotated_mat = cv2.warpAffine(mat, rotation_mat, (bound_w, bound_h))
-    return rotated_mat
+def upgradeDatabase(DB): # Bring an older database to the current schema (safe to run at every start)
+    for table in SCHEMA_TABLES:
+        DB.execute(table)
+    for table, column, definition in SCHEMA_COLUMNS:
+        if column not in [ r[1] for r in DB.execute("PRAGMA table_info(%s)" % table) ]:
+            DB.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, definition))
+    rows = DB.execute("SELECT id, faces FROM targetFaces WHERE templates IS NULL AND faces IS NOT NULL").fetchall()
+    if rows: # One-time migration from the JSON column
+        DB.execute("BEGIN")
+        for row in rows:
+            DB.execute("UPDATE targetFaces SET templates=?, faces=NULL WHERE id=?", (templatesToBlob(json.loads(row[1])), row[0]) )
+        DB.execute("COMMIT")
 
-def searchBestPlate(frame, alprObj):
-    plateRes = alprObj.recognize_ndarray(frame)
-    if plateRes and plateRes["results"] and plateRes["results"][0]["confidence"] > settings.OPENALPR_MIN_CONFIDENCE:
-        return plateRes["results"][0]["plate"]
-    else:
-        for angle in settings.OPENALPR_ROTATIONS:
-            frame_rot = rotate_image(frame, angle)
-            plateRes = alprObj.recognize_ndarray(frame_rot)
-            if plateRes and plateRes["results"] and plateRes["results"][0]["confidence"] > settings.OPENALPR_MIN_CONFIDENCE:
-                return plateRes["results"][0]["plate"]
-        return None
-            
 def initialChecks(parent = None):
     forceExit = False
     # Check db
@@ -1077,6 +1157,7 @@ if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv) # Start GUI
     initialChecks() # Do initial checks (after app instance)
     DB = sql.connect(settings.DB_PATH, isolation_level=None) # Open connection (automatically creates file if does not exist) in AUTOCOMMIT MODE
+    upgradeDatabase(DB)
     window = mainWindow() # Keep reference to main window
     window.show() # Open main window
     window.recognitionInitialization() # START ALL THE BACKGROUND PROCESSES
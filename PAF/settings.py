@@ -7,11 +7,47 @@ CUR_PATH = os.path.dirname(os.path.realpath(__file__)) #current path
 SHAPE_PREDICTOR = os.path.join(CUR_PATH,"res","shape_predictor_68_face_landmarks.dat")
 FACE_RECOGNITION_MODEL = os.path.join(CUR_PATH,"res","dlib_face_recognition_resnet_model_v1.dat")
 DB_PATH = os.path.join(CUR_PATH,"data","paf.db")
+GALLERY_PATH = os.path.join(CUR_PATH,"data","gallery") # Targets snapshot, memory-mapped by every worker
+TARGETS_POLL_INTERVAL = 2 # Seconds between checks for changed targets in workers
+STATS_INTERVAL = 10 # Seconds between updates of the cameraStats table
+CAPTURE_DEFAULT_FPS = 25 # Grab rate of live sources that do not report their FPS
+CAPTURE_BUFFER = 0 # Frames kept in the capture ring buffer of cameras (0 = current frame only), default for cameras
+CAPTURE_STALL_TIMEOUT = 10 # Seconds without frames before a camera stream is reopened (0 = never)
+CAPTURE_RECONNECT_MAX_DELAY = 60 # Max seconds between reconnection attempts (1, 2, 4... seconds before)
+FFMPEG_PATH = 'ffmpeg' # Executables of the ffmpeg capture backend (cameras with captureBackend = 'ffmpeg')
+FFPROBE_PATH = 'ffprobe'
+FFMPEG_THREADS = 2 # Decoding threads of each ffmpeg process
 EVENTS_PATH = os.path.join(CUR_PATH,'..','Events')
 # RECOGNITION TUNING
 MAX_DISTANCE = 0.50                                             # Face recognition min threshold
+FACE_INDEX_MIN_TEMPLATES = 20000                                # Approximate face search only above this number of templates (exact search below)
+FACE_INDEX_PROBES = 8                                           # Lists scanned per face (higher = better recall, slower)
+FACE_INDEX_LISTS = 0                                            # Number of lists (0 = square root of number of templates)
+FACE_DETECT_SCALE = 1.0                                         # Face detection on a resized frame (e.g. 0.5 = half size), default for cameras and files
+FACE_DETECT_UPSAMPLE = 1                                        # Upsampling of the face detector (each one doubles the size, finds smaller faces)
+FACE_MIN_SIZE = 0                                               # Detected faces smaller than this (pixels) are ignored
+FACE_TRACK_MIN_IOU = 0.3                                        # Min overlap to consider a face the same of the previous frame
+FACE_TRACK_MAX_AGE = 1.0                                        # Seconds a face track is kept without detections
+FACE_TRACK_REVERIFY = 5.0                                       # Seconds after which a tracked face is recognized again
+MOTION_WIDTH = 160                                              # Width of the frame copy analysed for motion (cameras with motionSensitivity)
+MOTION_THRESHOLD = 25                                           # Min intensity change of a pixel to be considered motion
+MOTION_HOLD = 2.0                                               # Seconds recognition keeps running after the last motion
 OPENALPR_COUNTRY = "eu"                                         # Country for Plate Recognition
 OPENALPR_MIN_CONFIDENCE = 0.5                                   # Plate confidence min threshold
 OPENALPR_CONF = '/etc/openalpr/openalpr.conf'                   # Openalpr configuration files
 OPENALPR_RUNTIME_DATA = '/usr/share/openalpr/runtime_data'      # Openalpr configuration files
+OPENALPR_TOP_N = 5                                              # Candidates per plate read, voted across frames
+PLATE_VOTE_MAX_GAP = 1.0                                        # Seconds without reads after which a vehicle event is saved
+PLATE_VOTE_MAX_DURATION = 30.0                                  # A vehicle in view for longer produces an event every this many seconds
+PLATE_VOTE_MIN_FRAMES = 1                                       # Vehicles read in fewer frames are discarded
+PLATE_SUPPRESS_SECONDS = 60                                     # No new event for the same plate seen again within this time (0 = disabled), default for cameras
+PLATE_SUPPRESS_SIZE = 1024                                      # Plates remembered per camera for the suppression
+PLATE_MAX_DISTANCE = 1                                          # Edits tolerated between a read plate and a target (0 or 1), O/0 B/8 I/1... are always tolerated
+PLATE_BLOOM_BITS = 10                                           # Bloom filter bits per plate key of the hotlist (more bits, fewer false positives)
 OPENALPR_ROTATIONS = [5,-5,10,-10,20,-20]                       # Image rotation angles (set to [] if not used)
+PLATE_PREFILTER = True                                          # Skip OpenALPR on frames without plate-like regions (cheap edge detection)
+ROTATION_MIN_HITS = 20                                          # Reads with rotations of a camera needed before pruning useless angles
+ROTATION_PRUNE_SHARE = 0.02                                     # Angles with a smaller share of the reads of a camera are pruned
+ROTATION_EXPLORE_EVERY = 50                                     # Every this many retries all angles are tried again
+OPENALPR_MAX_REGIONS = 4                                        # Rotations are tried only on this many plate-like regions
+OPENALPR_THREADS = 4                                            # OpenALPR instances (and threads) per process, shared by its cameras